@@ -0,0 +1,48 @@
+#!/usr/bin/env bash
+
+# Compare Nix evaluation time of an overlay applied to all ROS distros
+# with an overlay restricted by --overlay-distros.
+#
+# Usage: maint/bench-overlay-distros.sh [DISTRO] [RUNS]
+
+set -euo pipefail
+
+distro=${1:-jazzy}
+runs=${2:-5}
+top=$(cd "$(dirname "$0")/.." && pwd)
+tmp=$(mktemp -d)
+trap 'rm -rf "$tmp"' EXIT
+
+ros2nix() { python3 -m ros2nix "$@"; }
+export PYTHONPATH=$top${PYTHONPATH:+:$PYTHONPATH}
+
+nix_ros_overlay=$(nix eval --raw --impure --expr \
+    "(builtins.getFlake \"path:$top\").inputs.nix-ros-overlay.outPath")
+
+for variant in all selected; do
+    mkdir -p "$tmp/$variant"
+    cp -a "$top/test/ws" "$tmp/$variant/"
+    (
+        cd "$tmp/$variant"
+        opts=(--distro="$distro")
+        [[ $variant = selected ]] && opts+=(--overlay-distros="$distro")
+        ros2nix "${opts[@]}" $(find ws/src -name package.xml) 2> /dev/null
+    )
+done
+
+# Checking attribute presence in every distro forces instantiation of all
+# package sets the overlay is applied to, like tools iterating over
+# rosPackages do.
+expr='let pkgs = import ./. { nix-ros-overlay = '"$nix_ros_overlay"'; }; in
+  builtins.mapAttrs (_: p: p ? library) pkgs.rosPackages'
+
+for variant in all selected; do
+    cd "$tmp/$variant"
+    if command -v hyperfine > /dev/null; then
+        hyperfine --runs "$runs" --command-name "$variant" \
+                  "nix-instantiate --eval --strict --expr '$expr' > /dev/null"
+    else
+        echo "$variant:"
+        time (for _ in $(seq "$runs"); do nix-instantiate --eval --strict --expr "$expr" > /dev/null; done)
+    fi
+done
@@ -0,0 +1,104 @@
+"""
+Fast extraction of the package.xml fields needed before rendering.
+
+catkin_pkg.package.parse_package_string() validates the whole manifest
+and processes all its metadata. This is unnecessary for discovering
+workspace packages and their dependencies, for which PackageHeader
+provides the relevant subset of the catkin_pkg Package interface.
+"""
+
+from typing import List, Optional
+from xml.etree import ElementTree
+
+from catkin_pkg.condition import evaluate_condition
+
+
+class Conditional:
+    def __init__(self, name: str, condition: Optional[str]) -> None:
+        self.name = name
+        self.condition = condition
+        self.evaluated_condition: Optional[bool] = None
+
+    def evaluate_condition(self, context) -> Optional[bool]:
+        self.evaluated_condition = evaluate_condition(self.condition, context)
+        return self.evaluated_condition
+
+
+class PackageHeader:
+    """
+    Name, version, build type and dependencies of a package parsed from
+    package.xml without validation. The original XML is kept in the
+    package_xml attribute for later full parsing.
+    """
+
+    def __init__(self, package_xml: str) -> None:
+        self.package_xml = package_xml
+        root = ElementTree.fromstring(package_xml)
+        if root.tag != "package":
+            raise ValueError(f"Unexpected root element <{root.tag}> in package.xml")
+
+        self.package_format = int(root.get("format", "1"))
+        self.name = self._text(root, "name")
+        self.version = self._text(root, "version")
+
+        def deps(tag: str) -> List[Conditional]:
+            return [Conditional(n.text.strip(), n.get("condition")) for n in root.findall(tag)]
+
+        self.build_depends = deps("build_depend")
+        self.buildtool_depends = deps("buildtool_depend")
+        self.test_depends = deps("test_depend")
+        self.doc_depends = deps("doc_depend")
+        if self.package_format == 1:
+            self.build_export_depends = deps("run_depend")
+            self.buildtool_export_depends = []
+            self.exec_depends = deps("run_depend")
+        else:
+            self.build_export_depends = deps("build_export_depend")
+            self.buildtool_export_depends = deps("buildtool_export_depend")
+            self.exec_depends = deps("exec_depend")
+            for attr in ["build_depends", "build_export_depends", "exec_depends"]:
+                getattr(self, attr).extend(deps("depend"))
+
+        self.build_types = [
+            Conditional(n.text.strip(), n.get("condition"))
+            for n in root.findall("export/build_type")
+        ]
+
+    @property
+    def run_depends(self) -> List[Conditional]:
+        # Same semantics as catkin_pkg.package.Package.run_depends
+        run_depends: List[Conditional] = []
+        for dep in self.exec_depends + self.build_export_depends:
+            if not any(d.name == dep.name and d.condition == dep.condition for d in run_depends):
+                run_depends.append(dep)
+        return run_depends
+
+    @staticmethod
+    def _text(root: ElementTree.Element, tag: str) -> str:
+        node = root.find(tag)
+        if node is None or node.text is None:
+            raise ValueError(f"Missing <{tag}> in package.xml")
+        return node.text.strip()
+
+    def evaluate_conditions(self, context) -> None:
+        for attr in [
+            "build_depends",
+            "buildtool_depends",
+            "build_export_depends",
+            "buildtool_export_depends",
+            "exec_depends",
+            "test_depends",
+            "doc_depends",
+            "build_types",
+        ]:
+            for conditional in getattr(self, attr):
+                conditional.evaluate_condition(context)
+
+    def get_build_type(self) -> str:
+        # Same semantics as catkin_pkg.package.Package.get_build_type()
+        build_types = [b.name for b in self.build_types if b.evaluated_condition is not False]
+        if not build_types:
+            return "catkin"
+        if len(build_types) == 1:
+            return build_types[0]
+        raise ValueError(f"Only one <build_type> element is permitted in package {self.name}.")
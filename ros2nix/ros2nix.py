@@ -6,7 +6,11 @@
 
 from os.path import dirname
 import argcomplete, argparse
+import base64
 import difflib
+import functools
+import hashlib
+import heapq
 import io
 import itertools
 import json
@@ -14,17 +18,22 @@ import os
 import re
 import subprocess
 import sys
+import tempfile
+import time
 from contextlib import contextmanager
+from email import message_from_string
+from email.header import decode_header, make_header
 from pathlib import Path
 from textwrap import dedent, indent
-from typing import Iterable, Set, List
+from typing import Iterable, Set, List, Optional, TextIO
 
-from catkin_pkg.package import Package, parse_package_string
+from catkin_pkg.package import parse_package_string
 from superflore.exceptions import UnresolvedDependency
 from superflore.generators.nix.nix_package import NixPackage
 from superflore.utils import err, ok, resolve_dep, warn
 
 from .nix_expression import NixExpression, NixLicense
+from .package_header import PackageHeader
 
 
 # Copied from https://github.com/srstevenson/xdg-base-dirs
@@ -44,6 +53,523 @@ def xdg_cache_home() -> Path:
 cache_file = xdg_cache_home() / "ros2nix" / "git-cache.json"
 
 
+def load_git_cache(path) -> dict[str, dict[str, str]]:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_git_cache(path, git_cache: dict[str, dict[str, str]]) -> None:
+    """Store git cache atomically, so that concurrent readers never see a partial file."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", dir=os.path.dirname(os.path.abspath(path)), prefix=".git-cache-", delete=False
+    ) as f:
+        json.dump(git_cache, f)
+    os.replace(f.name, path)
+
+
+def merge_git_cache(
+    dst: dict[str, dict[str, str]], src: dict[str, dict[str, str]], overwrite: bool = False
+) -> tuple[int, int]:
+    """
+    Merge entries from `src` into `dst`. Entries for a different
+    revision replace those in `dst` only if `overwrite` is true.
+    Different hashes of the same revision (or of the same tree for
+    entries keyed by tree IDs) are reported as conflicts and the `dst`
+    entry is kept. Returns the number of updated entries and conflicts.
+    """
+    updated = conflicts = 0
+    for key, info in src.items():
+        old = dst.get(key)
+        if old == info:
+            continue
+        if old is not None and old.get("rev") == info.get("rev"):
+            warn(
+                f"Conflicting hashes for {key}"
+                + (f" at {info['rev']}" if "rev" in info else "")
+                + f": {old['sha256']} (kept) and {info['sha256']}"
+            )
+            conflicts += 1
+        elif old is None or overwrite:
+            dst[key] = {k: info[k] for k in ["rev", "sha256"] if k in info}
+            updated += 1
+    return updated, conflicts
+
+
+def cache_command(argv: list[str]) -> int:
+    """Implementation of `ros2nix cache` subcommand."""
+    parser = argparse.ArgumentParser(
+        prog="ros2nix cache",
+        description="Share the cache of git checkout hashes, e.g. between CI runners.",
+    )
+    parser.add_argument(
+        "action",
+        choices=["export", "import"],
+        help="Merge the cache to FILE (export) or FILE to the cache (import)",
+    )
+    parser.add_argument("file", metavar="FILE", help="File to export to or import from")
+    parser.add_argument(
+        "--cache-file",
+        metavar="PATH",
+        help="Path to the cache. If not given, $XDG_CACHE_HOME/ros2nix/git-cache.json is used.",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Replace entries with a different revision in the destination",
+    )
+    args = parser.parse_args(argv)
+    args.cache_file = args.cache_file or cache_file
+
+    src_file, dst_file = (
+        (args.cache_file, args.file) if args.action == "export" else (args.file, args.cache_file)
+    )
+    if not os.path.exists(src_file):
+        err(f"Cannot load cache: {src_file} does not exist")
+        return 1
+    try:
+        src = load_git_cache(src_file)
+        dst = load_git_cache(dst_file)
+    except (OSError, ValueError) as exc:
+        err(f"Cannot load cache: {exc}")
+        return 1
+    updated, conflicts = merge_git_cache(dst, src, args.overwrite)
+    save_git_cache(dst_file, dst)
+    ok(f"Merged {updated} entries from {src_file} to {dst_file} ({conflicts} conflicts).")
+    return 0
+
+
+def git_mirror(url: str, toplevel: str, rev: str) -> str:
+    """
+    Return the path of a bare mirror of the repository with remote
+    `url`, making sure that it contains `rev`. The mirror is kept in
+    the cache directory and shared by all local clones of the same
+    remote, so only objects not fetched before are copied from
+    `toplevel`.
+    """
+    url = re.sub(r"^(\w+://)[^@/]*@", r"\1", url)  # strip credentials
+    name = re.sub(r"(\.git)?/*$", "", url).rsplit("/", 1)[-1].rsplit(":", 1)[-1]
+    name = f"{name}-{hashlib.sha256(url.encode()).hexdigest()[:16]}"
+    mirror = str(xdg_cache_home() / "ros2nix" / "mirrors" / f"{name}.git")
+    if not os.path.exists(mirror):
+        subprocess.check_call(["git", "init", "--quiet", "--bare", mirror])
+    has_rev = subprocess.run(
+        ["git", f"--git-dir={mirror}", "cat-file", "-e", f"{rev}^{{commit}}"],
+        stderr=subprocess.DEVNULL,
+    )
+    if has_rev.returncode != 0:
+        # Keep a ref per local clone so that fetched objects are not garbage collected
+        ref = f"refs/ros2nix/{hashlib.sha256(toplevel.encode()).hexdigest()[:16]}"
+        subprocess.check_call(
+            ["git", f"--git-dir={mirror}", "fetch", "--quiet", "--no-tags"]
+            + [toplevel, f"+HEAD:{ref}"]
+        )
+    return mirror
+
+
+def sparse_dirs(git_dir: str, rev: str, sparse_prefix: str) -> list[str]:
+    """
+    Return directories of `rev` matched by the non-cone sparse-checkout
+    pattern `sparse_prefix`. A single-component pattern like "pkg/"
+    matches directories of that name at any depth, except those inside
+    another matched directory.
+    """
+    name = sparse_prefix.rstrip("/")
+    if "/" in name:
+        return [sparse_prefix]
+    tree_dirs = subprocess.check_output(
+        ["git", f"--git-dir={git_dir}", "ls-tree", "-r", "-d", "-z", "--name-only", rev]
+    ).decode()
+    dirs: list[str] = []
+    for path in tree_dirs.split("\0"):
+        if path.rsplit("/", 1)[-1] == name and not any(path.startswith(d) for d in dirs):
+            dirs.append(path + "/")
+    return dirs
+
+
+def git_checkout_hash(git_dir: str, rev: str, sparse_prefix: str = "") -> str:
+    """
+    Compute sha256 hash of a checkout of `rev` in the same way as
+    nix-prefetch-git. If `sparse_prefix` is given, only this
+    sub-directory is checked out, as with nix-prefetch-git
+    --sparse-checkout <sparse_prefix> --non-cone-mode.
+    """
+    with tempfile.TemporaryDirectory(prefix="ros2nix-") as tmp:
+        checkout = os.path.join(tmp, "checkout")
+        os.mkdir(checkout)
+        git = ["git", f"--git-dir={git_dir}", f"--work-tree={checkout}"]
+        git += ["-c", "core.bare=false", "-c", "core.autocrlf=false"]
+        # Use a private index so that no repository state is modified
+        env = dict(os.environ, GIT_INDEX_FILE=os.path.join(tmp, "index"))
+        if not sparse_prefix:
+            subprocess.check_call(git + ["read-tree", rev], env=env)
+        for dir in sparse_dirs(git_dir, rev, sparse_prefix) if sparse_prefix else []:
+            subprocess.check_call(git + ["read-tree", f"--prefix={dir}", f"{rev}:{dir}"], env=env)
+        subprocess.check_call(git + ["checkout-index", "--all"], env=env)
+        return (
+            subprocess.check_output(["nix-hash", "--type", "sha256", "--base32", checkout])
+            .decode()
+            .strip()
+        )
+
+
+def last_modifying_commits(toplevel: str, rev: str, prefixes: Iterable[str]) -> dict[str, str]:
+    """
+    Find the newest commit changing each of `prefixes` (directories
+    relative to `toplevel` ending with "/", or "" for the whole
+    repository) in the history of `rev`. The result is the same as
+    from `git rev-list -1 <rev> -- <prefix>`, i.e., with the default
+    history simplification, which follows the first parent with the
+    same content at merges. The history is walked only once for all
+    prefixes, newest commits first, and all objects are read by a
+    single git cat-file process.
+    """
+    cat_file = subprocess.Popen(
+        ["git", "cat-file", "--batch"],
+        cwd=toplevel,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    assert cat_file.stdin is not None and cat_file.stdout is not None
+
+    def read(oid: str) -> bytes:
+        cat_file.stdin.write(oid.encode() + b"\n")
+        cat_file.stdin.flush()
+        header = cat_file.stdout.readline().split()
+        assert len(header) == 3, f"Cannot read object {oid}"
+        return cat_file.stdout.read(int(header[2]) + 1)[:-1]
+
+    @functools.cache
+    def commit(oid: str) -> tuple[int, str, list[str]]:
+        """Return the commit time, tree and parents of commit `oid`."""
+        headers = read(oid).split(b"\n\n", 1)[0].decode().split("\n")
+        tree = next(h.split()[1] for h in headers if h.startswith("tree "))
+        date = next(int(h.split()[-2]) for h in headers if h.startswith("committer "))
+        return date, tree, [h.split()[1] for h in headers if h.startswith("parent ")]
+
+    @functools.cache
+    def subdirs(tree: str) -> dict[bytes, str]:
+        """Return IDs of directories in `tree` by their names."""
+        data = read(tree)
+        result = {}
+        # Tree entries are "<mode> <name>\0<20-byte binary ID>"
+        pos = 0
+        while pos < len(data):
+            nul = data.index(b"\0", pos)
+            mode, name = data[pos:nul].split(b" ", 1)
+            if mode == b"40000":
+                result[name] = data[nul + 1 : nul + 21].hex()
+            pos = nul + 21
+        return result
+
+    @functools.cache
+    def subtree(tree: str, prefix: str) -> Optional[str]:
+        """Return ID of the `prefix` directory in `tree` or None if not present."""
+        if not prefix:
+            return tree
+        dirname, _, name = prefix.rstrip("/").rpartition("/")
+        parent = subtree(tree, dirname + "/" if dirname else "")
+        return None if parent is None else subdirs(parent).get(name.encode())
+
+    result: dict[str, str] = {}
+    # Prefixes whose last change is searched at or below a commit
+    pending: dict[str, set[str]] = {rev: set(prefixes)}
+    queue = [(-commit(rev)[0], rev)]
+    try:
+        while queue:
+            oid = heapq.heappop(queue)[1]
+            _, tree, parents = commit(oid)
+            for prefix in pending.pop(oid):
+                own = subtree(tree, prefix)
+                same = next((p for p in parents if subtree(commit(p)[1], prefix) == own), None)
+                if same is None:
+                    if parents or own is not None:
+                        result[prefix] = oid
+                    continue
+                if same not in pending:
+                    pending[same] = set()
+                    heapq.heappush(queue, (-commit(same)[0], same))
+                pending[same].add(prefix)
+    finally:
+        cat_file.stdin.close()
+        cat_file.kill()
+        cat_file.wait()
+    return result
+
+
+# First line of every patch generated by git format-patch --zero-commit
+patch_separator = "From 0000000000000000000000000000000000000000 Mon Sep 17 00:00:00 2001\n"
+
+
+def format_patches(toplevel: str, base: str) -> list[tuple[str, str, list[tuple[str, str]]]]:
+    """
+    Format all non-merge commits in base..HEAD with a single git
+    format-patch run. Return a list of (subject, header, diffs), where
+    header contains the mail headers and the commit message and diffs
+    is a list of (path, diff) pairs, one for each changed file.
+    """
+
+    def git(*args: str) -> str:
+        return subprocess.check_output(
+            ["git", "-c", "core.quotePath=false", *args], cwd=toplevel, text=True
+        )
+
+    mbox = git(
+        "format-patch",
+        "--stdout",
+        "--zero-commit",
+        "--no-signature",
+        "--no-stat",
+        "--no-renames",
+        "--no-numbered",
+        f"{base}..HEAD",
+    )
+    result = []
+    # The separator is recognized only at the start of a line, where it
+    # cannot come from diffs of (e.g. patch) files
+    for patch in re.split("^" + re.escape(patch_separator), mbox, flags=re.MULTILINE)[1:]:
+        header, *diffs = re.split(r"^(?=diff --git a/)", patch, flags=re.MULTILINE)
+        subject = str(make_header(decode_header(message_from_string(header)["Subject"])))
+        subject = re.sub(r"\s+", " ", subject.removeprefix("[PATCH] "))
+        result.append(
+            (
+                subject,
+                header,
+                [(re.match(r"diff --git a/(.*) b/", diff)[1], diff) for diff in diffs],
+            )
+        )
+    return result
+
+
+def patch_file_name(number: int, subject: str) -> str:
+    """Return the same file name as git format-patch."""
+    sanitized = re.sub(r"[^A-Za-z0-9._]+", "-", re.sub(r"\.\.+", ".", subject))
+    name = f"{number:04d}-" + sanitized.strip("-").rstrip(".-")
+    return name[:57] + ".patch"
+
+
+def package_patches(
+    commits: list[tuple[str, str, list[tuple[str, str]]]], prefix: str
+) -> list[tuple[str, str]]:
+    """
+    Select changes under `prefix` from `commits` (see format_patches())
+    and return them as (file name, content) pairs with paths relative to
+    `prefix`, as generated by git format-patch --relative.
+    """
+    patches = []
+    for subject, header, diffs in commits:
+        selected = [diff for path, diff in diffs if path.startswith(prefix)]
+        if not selected:
+            continue
+        headers, _, message = header.partition("\n\n")
+        message = message.strip("\n")
+        content = (
+            patch_separator + headers + "\n\n" + (message + "\n" if message else "") + "---\n\n"
+        )
+        for diff in selected:
+            lines = diff.splitlines(keepends=True)
+            for i, line in enumerate(lines):
+                if line.startswith(("@@", "GIT binary patch", "Binary files")):
+                    break
+                lines[i] = re.sub(
+                    rf"(^diff --git a/| b/|^--- a/|^\+\+\+ b/){re.escape(prefix)}", r"\1", line
+                )
+            content += "".join(lines)
+        patches.append((patch_file_name(len(patches) + 1, subject), content))
+    return patches
+
+
+class Events:
+    """Machine-readable progress events written as JSON lines (see --events)."""
+
+    def __init__(self, file: Optional[TextIO] = None) -> None:
+        self.file = file
+        self.started: dict[tuple[str, Optional[str]], float] = {}
+
+    def emit(self, event: str, stage: str, package: Optional[str] = None, **fields) -> None:
+        if self.file is None:
+            return
+        record = {"time": time.time(), "event": event, "stage": stage}
+        if package is not None:
+            record["package"] = package
+        self.file.write(json.dumps(record | fields) + "\n")
+        self.file.flush()
+
+    def start(self, stage: str, package: Optional[str] = None, **fields) -> None:
+        self.started[(stage, package)] = time.monotonic()
+        self.emit("start", stage, package, **fields)
+
+    def finish(self, stage: str, package: Optional[str] = None, **fields) -> None:
+        start = self.started.pop((stage, package), None)
+        if start is None:
+            # Stages like parse are started before the package name is known
+            start = self.started.pop((stage, None), None)
+        if start is not None:
+            fields["duration"] = round(time.monotonic() - start, 6)
+        self.emit("finish", stage, package, **fields)
+
+    def close(self) -> None:
+        if self.file is not None and self.file is not sys.stderr:
+            self.file.close()
+
+
+@functools.cache
+def tree_cache_key(toplevel: str, rev: str, sparse_prefix: str = "") -> str:
+    """
+    Return the git_cache key of the tree checked out from `rev`. The
+    hash of a checkout depends only on the tree (and on the prefix of a
+    sparse checkout), so entries are shared by all commits and remotes
+    with the same content. `rev` must be a commit ID, because results
+    are memoized.
+    """
+    # Single-component non-cone patterns match at any depth, so the
+    # checkout depends on the whole tree
+    path = sparse_prefix if "/" in sparse_prefix.rstrip("/") else ""
+    tree = (
+        subprocess.check_output(["git", "rev-parse", f"{rev}:{path}"], cwd=toplevel)
+        .decode()
+        .strip()
+    )
+    return f"git-tree:{tree}:{sparse_prefix}" if sparse_prefix else f"git-tree:{tree}"
+
+
+def git_cache_lookup(
+    git_cache: dict[str, dict[str, str]], key: str, toplevel: str, rev: str, sparse_prefix: str = ""
+) -> Optional[dict[str, str]]:
+    """
+    Return {"rev": ..., "sha256": ...} for a checkout of `rev` if its
+    hash is in `git_cache` under `key` or under its tree ID, otherwise
+    None.
+    """
+    info = git_cache.get(key)
+    if info is not None and info["rev"] == rev:
+        return info
+    tree_info = git_cache.get(tree_cache_key(toplevel, rev, sparse_prefix))
+    if tree_info is None:
+        return None
+    git_cache[key] = {"rev": rev, "sha256": tree_info["sha256"]}
+    return git_cache[key]
+
+
+class CacheMiss(Exception):
+    """Raised with --cache-only when a hash is not in the git cache."""
+
+
+def git_prefetch(
+    git_cache: dict[str, dict[str, str]],
+    key: str,
+    url: str,
+    toplevel: str,
+    rev: str,
+    sparse_prefix: str = "",
+    use_mirror: bool = False,
+    cache_only: bool = False,
+) -> dict[str, str]:
+    """
+    Prefetch a checkout of `rev`, which is not in `git_cache` (see
+    git_cache_lookup()), and return {"rev": ..., "sha256": ...}. The
+    result is stored in `git_cache` under `key` and under the tree ID
+    of the checkout. With `cache_only`, raise CacheMiss instead of
+    prefetching.
+    """
+    if cache_only:
+        raise CacheMiss(f"{key} at {rev}")
+    if use_mirror:
+        mirror = git_mirror(url, toplevel, rev)
+        info = {"rev": rev, "sha256": git_checkout_hash(mirror, rev, sparse_prefix)}
+    else:
+        info = json.loads(
+            subprocess.check_output(
+                ["nix-prefetch-git", "--quiet"]
+                + (["--sparse-checkout", sparse_prefix, "--non-cone-mode"] if sparse_prefix else [])
+                + [toplevel, rev],
+            ).decode()
+        )
+    git_cache[key] = {k: info[k] for k in ["rev", "sha256"]}
+    git_cache[tree_cache_key(toplevel, rev, sparse_prefix)] = {"sha256": info["sha256"]}
+    return git_cache[key]
+
+
+# Fetchers downloading tarballs from software forges, see --forge-host
+forge_fetchers = {
+    "github": "fetchFromGitHub",
+    "gitlab": "fetchFromGitLab",
+    "gitea": "fetchFromGitea",
+    "bitbucket": "fetchFromBitbucket",
+    "sourcehut": "fetchFromSourcehut",
+}
+forge_hosts = {
+    "github.com": "github",
+    "gitlab.com": "gitlab",
+    "codeberg.org": "gitea",
+    "bitbucket.org": "bitbucket",
+    "git.sr.ht": "sourcehut",
+}
+
+
+def forge_source(
+    url: str, extra_hosts: dict[str, str], sparse: bool = False
+) -> Optional[tuple[str, dict[str, str]]]:
+    """
+    Return the nixpkgs fetcher and its arguments (except rev and
+    sha256) for downloading repository `url` as a tarball from a
+    software forge or None if the forge is not known. The fetchers
+    unpack the tarball to the same content as a checkout, so the hash
+    computed from the local git tree can be used.
+
+    Only fetchFromGitHub and fetchFromGitLab support sparse checkouts.
+    """
+    m = re.match(
+        r"(?:(?P<scheme>\w+)://)?(?:[^@/]*@)?(?P<host>[^/:@]+)(?::(?P<port>\d+)/|:|/)"
+        r"(?P<path>[^:]+?)(?:\.git)?/*$",
+        url,
+    )
+    if m is None:
+        return None
+    host = m["host"].lower()
+    # Fetchers download tarballs over HTTPS, so the port of an HTTPS
+    # remote must be kept, whereas the port of SSH remotes is irrelevant.
+    base = host
+    if m["port"] and m["scheme"] in ("http", "https"):
+        if m["scheme"] == "http":
+            return None
+        base = f"{host}:{m['port']}"
+    forge = extra_hosts.get(host) or forge_hosts.get(host)
+    if forge is None and host.split(".")[0] in ("gitlab", "gitea", "forgejo"):
+        forge = "gitea" if host.startswith(("gitea.", "forgejo.")) else "gitlab"
+    if forge is None or (sparse and forge not in ("github", "gitlab")):
+        return None
+    components = m["path"].split("/")
+    if len(components) < 2:
+        return None
+    if forge == "gitlab":
+        # GitLab projects can be nested in subgroups
+        owner, repo = "/".join(components[:-1]), components[-1]
+    else:
+        owner, repo = components[0], components[1]
+
+    attrs = {}
+    if forge == "github" and base != "github.com":
+        attrs["githubBase"] = base
+    elif forge == "gitlab" and base != "gitlab.com":
+        attrs["domain"] = base
+    elif forge == "gitea":
+        attrs["domain"] = base
+    elif forge == "sourcehut" and base != "git.sr.ht":
+        attrs["domain"] = base.removeprefix("git.")
+    elif forge == "bitbucket" and base != "bitbucket.org":
+        return None  # fetchFromBitbucket supports only bitbucket.org
+    attrs["owner"] = owner
+    attrs["repo"] = repo
+    return forge_fetchers[forge], attrs
+
+
+# Ignored by --filter-src in addition to .gitignore
+src_filter_patterns = ['".git"', '"/build/"', '"/install/"', '"/log/"', '"*.bag"', '"*.mcap"']
+
+
 def resolve_dependencies(deps: Iterable[str]) -> Set[str]:
     return set(itertools.chain.from_iterable(map(resolve_dependency, deps)))
 
@@ -72,7 +598,78 @@ def get_dependencies_as_set(pkg, dep_type):
     return set([d.name for d in deps[dep_type] if d.evaluated_condition is not False])
 
 
-def get_output_file_name(source: str, pkg: Package, args):
+def get_package_inputs(pkg: PackageHeader, args) -> dict[str, set[str]]:
+    """Return NixExpression inputs of a package with already evaluated conditions."""
+    buildtool_deps = get_dependencies_as_set(pkg, "buildtool")
+    buildtool_export_deps = get_dependencies_as_set(pkg, "buildtool_export")
+    build_deps = get_dependencies_as_set(pkg, "build")
+    build_export_deps = get_dependencies_as_set(pkg, "build_export")
+    exec_deps = get_dependencies_as_set(pkg, "exec")
+    test_deps = get_dependencies_as_set(pkg, "test")
+
+    # buildtool_depends are added to buildInputs and nativeBuildInputs.
+    # Some (such as CMake) have binaries that need to run at build time
+    # (and therefore need to be in nativeBuildInputs. Others (such as
+    # ament_cmake_*) need to be added to CMAKE_PREFIX_PATH and therefore
+    # need to be in buildInputs. There is no easy way to distinguish these
+    # two cases, so they are added to both, which generally works fine.
+    build_inputs = set(resolve_dependencies(build_deps | buildtool_deps))
+    propagated_build_inputs = resolve_dependencies(
+        exec_deps | build_export_deps | buildtool_export_deps
+    )
+    build_inputs -= propagated_build_inputs
+
+    check_inputs = resolve_dependencies(test_deps)
+    check_inputs -= build_inputs
+
+    native_build_inputs = resolve_dependencies(buildtool_deps | buildtool_export_deps)
+
+    return {
+        "build_inputs": build_inputs | set(args.extra_build_inputs),
+        "propagated_build_inputs": propagated_build_inputs
+        | set(args.extra_propagated_build_inputs),
+        "check_inputs": check_inputs | set(args.extra_check_inputs),
+        "native_build_inputs": native_build_inputs | set(args.extra_native_build_inputs),
+    }
+
+
+def get_workspace_dependencies(pkg) -> Set[str]:
+    dep_types = ["build", "buildtool", "build_export", "buildtool_export", "exec", "test"]
+    return set().union(*(get_dependencies_as_set(pkg, t) for t in dep_types))
+
+
+def select_packages(
+    packages: list[tuple[str, PackageHeader]],
+    select: list[str],
+    up_to: list[str],
+    distros: list[str],
+) -> list[tuple[str, PackageHeader]]:
+    """Return the subset of (source, package) pairs selected by
+    --packages-select and --packages-up-to, keeping their original order."""
+    by_name = {pkg.name: pkg for _, pkg in packages}
+
+    def dependencies(pkg: PackageHeader) -> Set[str]:
+        deps = set()
+        for distro in distros:
+            pkg.evaluate_conditions(NixPackage._get_condition_context(distro))
+            deps |= get_workspace_dependencies(pkg)
+        return deps
+
+    # --packages-up-to includes workspace dependencies recursively
+    up_to_closure: set[str] = set()
+    todo = list(up_to)
+    while todo:
+        name = todo.pop()
+        if name in up_to_closure:
+            continue
+        up_to_closure.add(name)
+        todo.extend(dep for dep in dependencies(by_name[name]) if dep in by_name)
+
+    selected = set(select) | up_to_closure
+    return [(source, pkg) for source, pkg in packages if pkg.name in selected]
+
+
+def get_output_file_name(source: str, pkg: PackageHeader, args):
     if args.output_as_ros_pkg_name:
         fn = f"{pkg.name}.nix"
     elif args.output_as_nix_pkg_name:
@@ -85,6 +682,28 @@ def get_output_file_name(source: str, pkg: Package, args):
     return os.path.join(dir, fn)
 
 
+def distro_file_name(file_name: str, distro: str) -> str:
+    """Return the name of a distro-specific variant of a .nix file."""
+    return re.sub(r"(\.nix)?$", rf".{distro}\1", file_name, count=1)
+
+
+def existing_expressions(source: str, pkg: PackageHeader, args) -> dict[str, str]:
+    """Return expression files of `pkg` generated by a previous run, keyed by distro."""
+    output_file_name = get_output_file_name(source, pkg, args)
+    found = {}
+    for distro in args.distros:
+        for file_name in [distro_file_name(output_file_name, distro), output_file_name]:
+            if os.path.exists(file_name):
+                found[distro] = file_name
+                break
+    return found
+
+
+def overlay_file_name(args, distro: str) -> str:
+    overlay = f'{args.output_dir or "."}/overlay.nix'
+    return overlay if len(args.distros) == 1 else distro_file_name(overlay, distro)
+
+
 def nix_ident(s: str) -> str:
     # Nix identifiers can contain letters, numbers, underscores, apostrophes and hyphens, but cannot
     # start with a number, apostrophe or a hyphen.
@@ -131,8 +750,42 @@ def file_writer(path: str, compare: bool):
         f.close()
 
 
-def generate_overlay(expressions: dict[str, str], args):
-    with file_writer(f'{args.output_dir or "."}/overlay.nix', args.compare) as f:
+def generate_overlay_by_name(args, overlay_file: str, distro: str):
+    """
+    Generate overlay, which finds packages in <nix-name>/package.nix
+    subdirectories (see --output-as-pkg-dir) at evaluation time. The
+    overlay doesn't change when packages are added or removed.
+    """
+    if len(args.distros) == 1:
+        pkg_file = '''pkgFile = name: ./. + "/${name}/package.nix";'''
+    else:
+        pkg_file = dedent(f'''
+            pkgFile =
+              name:
+              let
+                distroFile = ./. + "/${{name}}/package.{distro}.nix";
+              in
+              if builtins.pathExists distroFile then distroFile else ./. + "/${{name}}/package.nix";''').strip()
+    with file_writer(overlay_file, args.compare) as f:
+        f.write(f'''final: prev:
+let
+  entries = builtins.readDir ./.;
+  {indent(pkg_file, "  ").strip()}
+  names = builtins.filter (
+    name: entries.${{name}} == "directory" && builtins.pathExists (pkgFile name)
+  ) (builtins.attrNames entries);
+in
+builtins.listToAttrs (
+  map (name: {{
+    inherit name;
+    value = final.callPackage (pkgFile name) {{ }};
+  }}) names
+)
+''')
+
+
+def generate_overlay(expressions: dict[str, str], args, overlay_file: str):
+    with file_writer(overlay_file, args.compare) as f:
         print("final: prev:\n{", file=f)
         for pkg in sorted(expressions):
             expr = (
@@ -144,23 +797,86 @@ def generate_overlay(expressions: dict[str, str], args):
         print("}", file=f)
 
 
-def ros_distro_overlays_def(ros_sources: str = "") -> str:
-    return dedent(
-        """
-        applyDistroOverlay =
-          rosOverlay: rosPackages:
-          rosPackages
-          // builtins.mapAttrs (
-            rosDistro: rosPkgs: if rosPkgs ? overrideScope then rosPkgs.overrideScope rosOverlay else rosPkgs
-          ) rosPackages;
-        rosDistroOverlays = final: prev: {
-          # Apply the overlay to multiple ROS distributions
-          rosPackages = applyDistroOverlay (import ./overlay.nix) prev.rosPackages;
-"""
-        + indent(ros_sources, "          ")
-        + """        };
-"""
-    ).strip()
+def released_packages(args, distro: str) -> dict[str, dict[str, str]]:
+    """
+    Return versions (and optionally source hashes) of packages released
+    in `distro`, keyed by ROS package name. The information is read from
+    --released-snapshot or from the rosdistro index at
+    $ROSDISTRO_INDEX_URL, which nix-ros-overlay is generated from.
+    """
+    if args.released_snapshot:
+        with open(args.released_snapshot) as f:
+            return json.load(f).get(distro, {})
+
+    import rosdistro
+
+    dist = rosdistro.get_distribution_file(rosdistro.get_index(rosdistro.get_index_url()), distro)
+    released = {}
+    for name, pkg in dist.release_packages.items():
+        release = dist.repositories[pkg.repository_name].release_repository
+        if release and release.version:
+            # Strip the release increment, e.g., 1.2.3-1 -> 1.2.3
+            released[name] = {"version": re.sub(r"-\d+$", "", release.version)}
+    return released
+
+
+def matches_release(pkg: PackageHeader, sha256: Optional[str], released: dict) -> bool:
+    """Check whether `pkg` is the same as the released package of the same name."""
+    release = released.get(pkg.name)
+    if release is None or release.get("version") != pkg.version:
+        return False
+    return "sha256" not in release or release["sha256"] == sha256
+
+
+def ros_distro_overlays_def(
+    ros_sources: str = "",
+    distros: Optional[list[str]] = None,
+    overlay_distros: Optional[list[str]] = None,
+) -> str:
+    """
+    Return Nix definition of rosDistroOverlays. If `overlay_distros` is
+    given, the overlay is applied only to these distros, otherwise to
+    all distros in rosPackages.
+    """
+    if distros is None or len(distros) == 1:
+        if overlay_distros is None:
+            target = "rosPackages"
+            comment = "Apply the overlay to multiple ROS distributions"
+        else:
+            target = f"{{ inherit (rosPackages) {' '.join(overlay_distros)}; }}"
+            comment = "Apply the overlay only to selected ROS distributions"
+        overlays_def = dedent(f"""
+            applyDistroOverlay =
+              rosOverlay: rosPackages:
+              rosPackages
+              // builtins.mapAttrs (
+                rosDistro: rosPkgs: if rosPkgs ? overrideScope then rosPkgs.overrideScope rosOverlay else rosPkgs
+              ) {target};
+            rosDistroOverlays = final: prev: {{
+              # {comment}
+              rosPackages = applyDistroOverlay (import ./overlay.nix) prev.rosPackages;
+            """)
+    else:
+        overlays_def = (
+            dedent("""
+                applyDistroOverlays =
+                  rosOverlays: rosPackages:
+                  rosPackages
+                  // builtins.mapAttrs (
+                    rosDistro: rosOverlay: rosPackages.${rosDistro}.overrideScope rosOverlay
+                  ) rosOverlays;
+                rosDistroOverlays = final: prev: {
+                  # Apply per-distro overlays to their ROS distributions
+                  rosPackages = applyDistroOverlays {
+                """)
+            + "".join(
+                f"    {distro} = import ./overlay.{distro}.nix;\n"
+                for distro in distros
+                if overlay_distros is None or distro in overlay_distros
+            )
+            + "  } prev.rosPackages;\n"
+        )
+    return (overlays_def + indent(ros_sources, "  ") + "};").strip()
 
 
 def flakeref_to_expr(flakeref) -> str:
@@ -192,7 +908,7 @@ def generate_default(args):
   nix-ros-overlay ? {nix_ros_overlay},
 }}:
 let
-{indent(ros_distro_overlays_def(), "  ")}
+{indent(ros_distro_overlays_def(distros=args.distros, overlay_distros=args.overlay_distros), "  ")}
 in
 import nix-ros-overlay {{
   overlays = [ rosDistroOverlays ];
@@ -200,8 +916,157 @@ import nix-ros-overlay {{
 ''')
 
 
-def generate_shell(args, packages: set[str], our_cmd_line: str):
+def generate_release(args):
+    """Generate release.nix evaluating to the workspace packages, e.g. for CI."""
+    nix_ros_overlay = flakeref_to_expr(args.nix_ros_overlay)
+    if len(args.distros) == 1:
+        overlay = "./overlay.nix"
+    else:
+        overlay = '(./. + "/overlay.${rosDistro}.nix")'
+    with file_writer(f'{args.output_dir or "."}/release.nix', args.compare) as f:
+        f.write(f'''{{
+  nix-ros-overlay ? {nix_ros_overlay},
+  rosDistro ? "{args.distro}",
+}}:
+let
+{indent(ros_distro_overlays_def(distros=args.distros, overlay_distros=args.overlay_distros), "  ")}
+  pkgs = import nix-ros-overlay {{
+    overlays = [ rosDistroOverlays ];
+  }};
+in
+builtins.intersectAttrs (import {overlay} null null) pkgs.rosPackages.${{rosDistro}}
+''')
+
+
+def dependency_levels(deps: dict[str, set[str]]) -> list[list[str]]:
+    """
+    Split packages into levels, where packages depend only on packages
+    from previous levels. `deps` maps package names to names of their
+    dependencies; dependencies not in `deps` are ignored. Packages
+    in dependency cycles (and their dependents) form the last level.
+    """
+    levels = []
+    remaining = set(deps)
+    while remaining:
+        level = sorted(p for p in remaining if not (deps[p] - {p}) & remaining)
+        if not level:
+            level = sorted(remaining)
+        levels.append(level)
+        remaining -= set(level)
+    return levels
+
+
+def split_to_shards(level: list[str], shards: int) -> list[list[str]]:
+    """
+    Distribute packages of one dependency level to at most `shards`
+    shards of similar size. Packages in a level don't depend on each
+    other, so the shards can be built in parallel without rebuilding
+    each other's packages.
+    """
+    return [level[i::shards] for i in range(min(shards, len(level)))]
+
+
+def generate_build_matrix(args, workspace_deps: dict[str, dict[str, set[str]]]):
+    """
+    Generate build-matrix.json with dependency levels of workspace
+    packages and their split to shards. Shards of the same level can be
+    built in parallel with nix-build release.nix --argstr rosDistro
+    <distro> -A <attr>... after all shards of the previous levels.
+    """
+    matrix: dict = {"levels": {}, "include": []}
+    for distro, deps in workspace_deps.items():
+        levels = dependency_levels(deps)
+        matrix["levels"][distro] = levels
+        for level, packages in enumerate(levels):
+            for i, shard in enumerate(split_to_shards(packages, args.shards)):
+                matrix["include"].append(
+                    {"distro": distro, "level": level, "shard": i, "attrs": shard}
+                )
+    with file_writer(f'{args.output_dir or "."}/build-matrix.json', args.compare) as f:
+        f.write(json.dumps(matrix, indent=2) + "\n")
+
+
+def propagated_inputs(args, distro: str, attrs: list[str]) -> dict[str, list[str]]:
+    """
+    Evaluate names of propagatedBuildInputs of `attrs` from
+    nix-ros-overlay. The attributes are looked up the same way as in
+    shell.nix, i.e., first in rosPackages.<distro>, then in nixpkgs.
+    """
+    expr = f'''
+      let
+        pkgs = import ({flakeref_to_expr(args.nix_ros_overlay)}) {{ }};
+        inherit (pkgs) lib;
+        lookup = attr: let path = lib.splitString "." attr; in
+          lib.attrByPath path (lib.attrByPath path null pkgs) pkgs.rosPackages.{distro};
+        name = drv: drv.pname or (builtins.parseDrvName drv.name).name;
+        propagated = attr: let drv = lookup attr; in
+          if lib.isDerivation drv
+          then map name (builtins.filter lib.isDerivation (drv.propagatedBuildInputs or [ ]))
+          else [ ];
+      in
+      lib.genAttrs [ {" ".join(json.dumps(a) for a in attrs)} ] propagated
+    '''
+    result = json.loads(
+        subprocess.check_output(["nix-instantiate", "--eval", "--strict", "--json", "--expr", expr])
+    )
+    ros_prefix = f"ros-{distro}-"
+    return {
+        attr: sorted({n.removeprefix(ros_prefix) for n in names}) for attr, names in result.items()
+    }
+
+
+def prune_propagated(args, distro: str, deps: set[str], index: dict[str, list[str]]) -> set[str]:
+    """
+    Remove dependencies propagated (transitively) by other dependencies
+    in `deps`. Propagated inputs of packages are taken from `index`,
+    which is extended by evaluating nix-ros-overlay if needed.
+    """
+    todo = sorted(deps - index.keys())
+    while todo:
+        found = propagated_inputs(args, distro, todo)
+        index.update(found)
+        todo = sorted({p for names in found.values() for p in names} - index.keys())
+
+    @functools.cache
+    def closure(attr: str) -> frozenset[str]:
+        result: set[str] = set()
+        stack = list(index.get(attr, []))
+        while stack:
+            p = stack.pop()
+            if p not in result:
+                result.add(p)
+                stack.extend(index.get(p, []))
+        return frozenset(result)
+
+    kept = set(deps)
+    for dep in sorted(deps):
+        if any(dep in closure(other) for other in kept if other != dep):
+            kept.remove(dep)
+    return kept
+
+
+def generate_shell(args, packages: dict[str, set[str]], our_cmd_line: str):
+    """Generate shell.nix with dependencies of workspace packages.
+
+    `packages` maps distros to sets of their dependencies. Dependencies
+    not shared by all distros are selected by the rosDistro parameter.
+    """
     nix_ros_overlay = flakeref_to_expr(args.nix_ros_overlay)
+    common = set.intersection(*packages.values())
+    dependencies = dedent('''
+        [
+          # Dependencies from package.xml files
+        ''').lstrip()
+    dependencies += indent("\n".join(sorted(list(common))), "  ") + "\n]"
+    if any(deps != common for deps in packages.values()):
+        # Conditional dependencies
+        dependencies += "\n++ {\n"
+        for distro, deps in packages.items():
+            if deps - common:
+                dependencies += f"  {distro} = [\n"
+                dependencies += indent("\n".join(sorted(list(deps - common))), "    ")
+                dependencies += "\n  ];\n"
+        dependencies += "}.${rosDistro} or [ ]"
     shell_nix = f'''# Automatically generated by: {our_cmd_line}
 {{
   nix-ros-overlay ? {nix_ros_overlay},
@@ -230,10 +1095,7 @@ pkgs.mkShell {{
           with pkgs;
           with pkgs.rosPackages.${{rosDistro}};
           with extraPkgs;
-          [
-            # Dependencies from package.xml files
-{indent('\n'.join(sorted(list(packages))), "            ")}
-          ]
+{indent(dependencies, "          ")}
         )
         ++ builtins.attrValues extraPkgs
         ++ extraPaths
@@ -256,16 +1118,68 @@ pkgs.mkShell {{
         f.write(shell_nix)
 
 
-def generate_ros_input(repo: str, info: dict[str, str]) -> str:
+def sri_hash(sha256: str) -> str:
+    """Convert sha256 hash in Nix base32 format (as output by nix-prefetch-git) to SRI format."""
+    if sha256.startswith("sha256-"):
+        return sha256
+    alphabet = "0123456789abcdfghijklmnpqrsvwxyz"
+    digest = bytearray(32)
+    for n, c in enumerate(reversed(sha256)):
+        digit = alphabet.index(c)
+        i, j = divmod(n * 5, 8)
+        digest[i] |= (digit << j) & 0xFF
+        if i + 1 < len(digest):
+            digest[i + 1] |= digit >> (8 - j)
+    return "sha256-" + base64.b64encode(digest).decode()
+
+
+def generate_ros_input(repo: str, info: dict) -> str:
     return dedent(f'''
         {repo} = {{
-          url = "github:{info["owner"]}/{info["repo"]}";
+          url = "github:{info["owner"]}/{info["repo"]}/{info["rev"]}";
           flake = false;
         }};
     ''').strip()
 
 
-def generate_flake(args, package_repos: dict[str, dict[str, str]]):
+def generate_flake_lock(args, package_repos: dict[str, dict]):
+    """
+    Write flake.lock entries for the ROS source inputs, so that Nix
+    doesn't need to fetch them again to lock the flake. Other inputs in
+    an existing flake.lock are preserved. Those not locked yet will be
+    added by Nix.
+    """
+    lock_file = f'{args.output_dir or "."}/flake.lock'
+    try:
+        with open(lock_file) as f:
+            lock = json.load(f)
+    except FileNotFoundError:
+        lock = {"nodes": {"root": {}}, "root": "root", "version": 7}
+    root = lock["nodes"][lock["root"]]
+    for ident, info in sorted(package_repos.items()):
+        root.setdefault("inputs", {})[ident] = ident
+        lock["nodes"][ident] = {
+            "flake": False,
+            "locked": {
+                "lastModified": info["lastModified"],
+                "narHash": info["narHash"],
+                "owner": info["owner"],
+                "repo": info["repo"],
+                "rev": info["rev"],
+                "type": "github",
+            },
+            "original": {
+                "owner": info["owner"],
+                "repo": info["repo"],
+                "rev": info["rev"],
+                "type": "github",
+            },
+        }
+    with file_writer(lock_file, args.compare) as f:
+        f.write(json.dumps(lock, indent=2, sort_keys=True) + "\n")
+
+
+def generate_flake(args, package_repos: dict[str, dict]):
     inputs = [
         f'''nix-ros-overlay.url = "{args.nix_ros_overlay}";''',
         f'''nixpkgs.follows = "nix-ros-overlay/nixpkgs";  # IMPORTANT!!!''',
@@ -280,6 +1194,7 @@ def generate_flake(args, package_repos: dict[str, dict[str, str]]):
         else ''
     )
 
+    overlay = os.path.basename(overlay_file_name(args, args.distro))
     with file_writer(f'{args.output_dir or "."}/flake.nix', args.compare) as f:
         f.write(
             f'''{{
@@ -289,7 +1204,7 @@ def generate_flake(args, package_repos: dict[str, dict[str, str]]):
   outputs = {{ self, nix-ros-overlay, nixpkgs, ... }}@inputs:
     nix-ros-overlay.inputs.flake-utils.lib.eachDefaultSystem (system:
       let
-{indent(ros_distro_overlays_def(ros_sources), "        ")}
+{indent(ros_distro_overlays_def(ros_sources, args.distros, args.overlay_distros), "        ")}
         pkgs = import nixpkgs {{
           inherit system;
           overlays = [
@@ -299,22 +1214,22 @@ def generate_flake(args, package_repos: dict[str, dict[str, str]]):
         }};
         rosDistro = "{args.distro}";
 '''
-            + '''
-      in {
+            + f'''
+      in {{
         legacyPackages = pkgs.rosPackages;
-        packages = builtins.intersectAttrs (import ./overlay.nix null null) pkgs.rosPackages.${rosDistro};
-        checks = builtins.intersectAttrs (import ./overlay.nix null null) pkgs.rosPackages.${rosDistro};
-        devShells.default = import ./shell.nix {
+        packages = builtins.intersectAttrs (import ./{overlay} null null) pkgs.rosPackages.${{rosDistro}};
+        checks = builtins.intersectAttrs (import ./{overlay} null null) pkgs.rosPackages.${{rosDistro}};
+        devShells.default = import ./shell.nix {{
           inherit pkgs rosDistro;
-          extraPkgs = { };
+          extraPkgs = {{ }};
           extraPaths = [ ];
-        };
-      });
-  nixConfig = {
+        }};
+      }});
+  nixConfig = {{
     extra-substituters = [ "https://ros.cachix.org" ];
     extra-trusted-public-keys = [ "ros.cachix.org-1:dSyZxI8geDCJrwgvCOHDoAfOm5sV1wCPjBkKL+38Rvo=" ];
-  };
-}
+  }};
+}}
 '''
         )
 
@@ -375,6 +1290,13 @@ def ros2nix(args):
         help="Generate a package.nix inside a directory whose name matches your Nix package name. "
         "e.g, package-name/package.nix. Implies --output-dir=.",
     )
+    parser.add_argument(
+        "--overlay-by-name",
+        action="store_true",
+        help="With --output-as-pkg-dir, generate overlay.nix that discovers package directories "
+        "with builtins.readDir instead of listing them. The overlay then doesn't need to be "
+        "regenerated when packages are added or removed.",
+    )
 
     parser.add_argument(
         "--output-dir",
@@ -391,16 +1313,28 @@ def ros2nix(args):
         default=None,  # used if --fetch not present
         help='''Fetch package sources with Nix from the origin of local Git repositories.
 
-        When set to "nixpkgs" (the default), use fetchers from nixpkgs (for example,
-        fetchFromGitHub) in the src attribute of package derivations.
+        When set to "nixpkgs" (the default), use fetchers from nixpkgs in the src attribute
+        of package derivations. Repositories from GitHub, GitLab, Gitea/Forgejo, Bitbucket and
+        sourcehut are downloaded as tarballs (e.g., with fetchFromGitHub), other repositories are
+        cloned with fetchgit.
 
         When set to "flake-inputs" and used with --flake, use flake inputs to fetch package sources
         and pass them to the package derivation through the rosSources parameter. This allows
-        fetching from private repositories.
+        fetching from private repositories. The inputs are pinned to the fetched revisions and
+        locked in flake.lock.
 
         In all cases, the sourceRoot attribute of package derivations is set automatically when
         required, unless it is explicitly overridden with --source-root.''',
     )
+    parser.add_argument(
+        "--forge-host",
+        action="append",
+        default=[],
+        metavar="HOST=TYPE",
+        help="With --fetch, treat repositories on HOST as hosted on a forge of TYPE "
+        f"({', '.join(forge_fetchers)}) and fetch them with the corresponding tarball fetcher. "
+        f"Known hosts are {', '.join(forge_hosts)} and hosts starting with gitlab., gitea. or forgejo.",
+    )
 
     parser.add_argument(
         "--name-format",
@@ -426,6 +1360,13 @@ def ros2nix(args):
         help="When using --fetch, fetch only the package sub-directory instead of the whole repo. "
         "For repos with multiple packages, this will avoid rebuilds of unchanged packages at the cost of longer generation time.",
     )
+    parser.add_argument(
+        "--git-mirror",
+        action="store_true",
+        help="Compute source hashes locally from a bare mirror of each remote repository "
+        "(stored in $XDG_CACHE_HOME/ros2nix/mirrors and updated incrementally) instead of "
+        "cloning the whole repository with nix-prefetch-git for every hash.",
+    )
     parser.add_argument(
         "--patches",
         action=argparse.BooleanOptionalAction,
@@ -435,10 +1376,36 @@ def ros2nix(args):
     )
     parser.add_argument(
         "--distro",
+        type=comma_separated,
+        metavar="DISTRO1,DISTRO2,...",
         default="rolling",
         help="ROS distro (used as a context for evaluation of conditions "
         "in package.xml, in the name of the Nix expression and in flake.nix). "
-        "Note that the generated Nix expression can be used with any ROS distro if its package.xml contains no conditions.",
+        "Note that the generated Nix expression can be used with any ROS distro if its package.xml contains no conditions. "
+        "When multiple distros are given, package.xml files are parsed and fetched only once, "
+        "expressions that differ between distros are stored in files "
+        "with the distro name before the .nix suffix (e.g. package.jazzy.nix) and "
+        "overlay.nix is replaced with per-distro overlay.<distro>.nix files. "
+        "Identical expressions are shared by all distros, which requires "
+        "--name-format without {distro}. "
+        "The first distro is the default one in shell.nix and flake.nix.",
+    )
+    parser.add_argument(
+        "--overlay-distros",
+        type=comma_separated,
+        metavar="DISTRO1,DISTRO2,...",
+        help="Apply the generated overlay only to the given ROS distros "
+        "instead of to all distros in rosPackages (default.nix, flake.nix). "
+        "This avoids instantiating package sets of other distros when the whole "
+        "rosPackages attribute set is evaluated. Defaults to --distro with --flake.",
+    )
+    parser.add_argument(
+        "--filter-src",
+        action="store_true",
+        help="When not using --fetch, filter local package sources with nix-gitignore "
+        "to exclude files ignored by the package's .gitignore, VCS data, colcon build/install/log "
+        "directories and ROS bag files. "
+        "This prevents copying them to the Nix store and rebuilding packages when they change.",
     )
     parser.add_argument(
         "--src-param",
@@ -454,6 +1421,42 @@ def ros2nix(args):
         action="store_true",
         help="Don't use cache of git checkout sha265 hashes across generation runs.",
     )
+    parser.add_argument(
+        "--keep-going",
+        action="store_true",
+        help="Do not stop at packages that fail to be generated. "
+        "Report them at the end, keep their previously generated expressions in the overlay "
+        "and exit with an error.",
+    )
+    parser.add_argument(
+        "--events",
+        choices=["jsonl"],
+        help="Report progress as machine-readable events. With jsonl, one JSON object "
+        "per line is written when a package or one of its stages "
+        "(parse, resolve, git, prefetch, render, write) starts and finishes. "
+        "The final run finish event is written even when ros2nix fails and its status "
+        "is ok, error or cache-miss.",
+    )
+    parser.add_argument(
+        "--events-file",
+        default="-",
+        metavar="PATH",
+        help="Where to write --events. '-' means standard error; "
+        "use /dev/fd/N to write to an inherited file descriptor.",
+    )
+    parser.add_argument(
+        "--cache-only",
+        action="store_true",
+        help="With --fetch, take hashes only from the cache and never run nix-prefetch-git. "
+        "Packages not found in the cache are reported and the run fails.",
+    )
+    parser.add_argument(
+        "--cache-file",
+        metavar="PATH",
+        help="Path to the cache of git checkout sha256 hashes. "
+        "If not given, $XDG_CACHE_HOME/ros2nix/git-cache.json is used. "
+        "Use `ros2nix cache export/import FILE` to share the cache between machines.",
+    )
     parser.add_argument(
         "--do-check",
         action="store_true",
@@ -488,6 +1491,23 @@ def ros2nix(args):
         default=[],
         help="Additional dependencies to add to the generated Nix expressions",
     )
+    parser.add_argument(
+        "--packages-select",
+        type=comma_separated,
+        metavar="PKG1,PKG2,...",
+        default=[],
+        help="Generate Nix expressions only for the given ROS packages. "
+        "All package.xml files are still used to identify workspace packages, "
+        "and the overlay and shell.nix still cover all of them.",
+    )
+    parser.add_argument(
+        "--packages-up-to",
+        type=comma_separated,
+        metavar="PKG1,PKG2,...",
+        default=[],
+        help="Generate Nix expressions only for the given ROS packages "
+        "and their recursive dependencies from the workspace.",
+    )
     parser.add_argument(
         "--package-only",
         nargs=0,
@@ -505,12 +1525,54 @@ def ros2nix(args):
         action=argparse.BooleanOptionalAction,
         help="Enforce/suppress generation of default.nix",
     )
+    parser.add_argument(
+        "--release",
+        action="store_true",
+        help="Generate release.nix evaluating to the workspace packages and build-matrix.json, "
+        "which splits the packages into dependency levels and shards for parallel CI builds",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Maximum number of shards per dependency level in build-matrix.json generated by --release",
+    )
+    parser.add_argument(
+        "--prune-shell",
+        action="store_true",
+        help="Omit dependencies from shell.nix that are propagated by other listed dependencies. "
+        "Propagated inputs are evaluated from nix-ros-overlay and cached in the closure index.",
+    )
+    parser.add_argument(
+        "--closure-index",
+        metavar="FILE",
+        help="Closure index used by --prune-shell. "
+        "If not given, $XDG_CACHE_HOME/ros2nix/closure-index.json is used. "
+        "Remove it to re-evaluate propagated inputs after updating nix-ros-overlay.",
+    )
     parser.add_argument(
         "--overlay",
         action=argparse.BooleanOptionalAction,
         default=True,
         help="Generate overlay.nix",
     )
+    parser.add_argument(
+        "--skip-released",
+        action="store_true",
+        help="Don't add packages with the same name and version as released in the ROS distro "
+        "to overlay.nix so that the binary-cached packages from nix-ros-overlay are used. "
+        "Expressions for such packages are still generated. Packages with local commits are "
+        "never skipped with --fetch, but without --fetch, local modifications cannot be "
+        "detected and only the version is compared.",
+    )
+    parser.add_argument(
+        "--released-snapshot",
+        metavar="FILE",
+        help="JSON file with released packages used by --skip-released instead of the rosdistro "
+        'index, e.g., {"jazzy": {"pkg": {"version": "1.0.0", "sha256": "..."}}}. '
+        "If sha256 is given, the package matches only if --fetch computes the same source hash.",
+    )
     parser.add_argument(
         "--packages",
         action=argparse.BooleanOptionalAction,
@@ -555,6 +1617,28 @@ def ros2nix(args):
     argcomplete.autocomplete(parser)
     args = parser.parse_args()
 
+    args.cache_file = args.cache_file or cache_file
+    args.distros = list(dict.fromkeys(args.distro))  # deduplicated, ordered
+    args.distro = args.distros[0]
+    if args.overlay_distros is None and args.flake:
+        args.overlay_distros = args.distros
+    if args.overlay_distros is not None:
+        args.overlay_distros = list(dict.fromkeys(args.overlay_distros))
+        if len(args.distros) > 1 and not set(args.overlay_distros) <= set(args.distros):
+            err("--overlay-distros must be a subset of --distro when multiple distros are given")
+            return 1
+
+    forge_host = {}
+    for spec in args.forge_host:
+        host, _, forge = spec.partition("=")
+        if forge not in forge_fetchers:
+            err(
+                f"Invalid --forge-host {spec}, expected HOST=TYPE with TYPE one of {', '.join(forge_fetchers)}"
+            )
+            return 1
+        forge_host[host.lower()] = forge
+    args.forge_host = forge_host
+
     if args.output_dir is None and (
         args.output_as_nix_pkg_name or args.output_as_ros_pkg_name or args.output_as_pkg_dir
     ):
@@ -574,6 +1658,34 @@ def ros2nix(args):
         err("--patches cannot be used without --fetch")
         return 1
 
+    if args.filter_src and (args.fetch or args.src_param):
+        err("--filter-src cannot be used with --fetch or --src-param")
+        return 1
+
+    if args.overlay_by_name and not args.output_as_pkg_dir:
+        err("--overlay-by-name requires --output-as-pkg-dir")
+        return 1
+
+    if args.skip_released and args.overlay_by_name:
+        err("--skip-released cannot be used with --overlay-by-name")
+        return 1
+
+    if args.released_snapshot and not args.skip_released:
+        err("--released-snapshot cannot be used without --skip-released")
+        return 1
+
+    if args.shards < 1:
+        err("--shards must be a positive number")
+        return 1
+
+    if args.cache_only and (args.no_cache or not args.fetch):
+        err("--cache-only requires --fetch and cannot be used with --no-cache")
+        return 1
+
+    if args.git_mirror and not args.fetch:
+        err("--git-mirror cannot be used without --fetch")
+        return 1
+
     our_cmd_line = " ".join(
         [os.path.basename(sys.argv[0])]
         + [
@@ -583,320 +1695,603 @@ def ros2nix(args):
         ]
     )
 
-    expressions: dict[str, str] = {}
+    expressions: dict[str, dict[str, str]] = {distro: {} for distro in args.distros}
     git_cache = {}
-    if not args.no_cache and os.path.exists(cache_file):
-        with open(cache_file) as f:
-            git_cache = json.load(f)
-    patch_filenames = set()
-    our_pkg_names: set[str] = set()
-    all_dependencies: set[str] = set()
-    source_repos: dict[str, dict[str, str]] = {}
-
-    for source in args.source:
-        try:
-            with open(source, 'r') as f:
-                package_xml = f.read()
-
-            pkg = parse_package_string(package_xml)
-            pkg.evaluate_conditions(NixPackage._get_condition_context(args.distro))
-
-            buildtool_deps = get_dependencies_as_set(pkg, "buildtool")
-            buildtool_export_deps = get_dependencies_as_set(pkg, "buildtool_export")
-            build_deps = get_dependencies_as_set(pkg, "build")
-            build_export_deps = get_dependencies_as_set(pkg, "build_export")
-            exec_deps = get_dependencies_as_set(pkg, "exec")
-            test_deps = get_dependencies_as_set(pkg, "test")
-
-            # buildtool_depends are added to buildInputs and nativeBuildInputs.
-            # Some (such as CMake) have binaries that need to run at build time
-            # (and therefore need to be in nativeBuildInputs. Others (such as
-            # ament_cmake_*) need to be added to CMAKE_PREFIX_PATH and therefore
-            # need to be in buildInputs. There is no easy way to distinguish these
-            # two cases, so they are added to both, which generally works fine.
-            build_inputs = set(resolve_dependencies(build_deps | buildtool_deps))
-            propagated_build_inputs = resolve_dependencies(
-                exec_deps | build_export_deps | buildtool_export_deps
+    if not args.no_cache:
+        git_cache = load_git_cache(args.cache_file)
+    patch_files: dict[str, str] = {}  # written patches and their content
+    all_dependencies: dict[str, set[str]] = {distro: set() for distro in args.distros}
+    # Dependencies needed to build each package, used for build-matrix.json
+    workspace_deps: dict[str, dict[str, set[str]]] = {distro: {} for distro in args.distros}
+    source_repos: dict[str, dict] = {}
+
+    if args.events is None:
+        events = Events()
+    elif args.events_file == "-":
+        events = Events(sys.stderr)
+    else:
+        events = Events(open(args.events_file, "w"))
+    events.start("run", sources=len(args.source))
+    # Updated when the run ends normally, emitted even on exceptions
+    run_fields: dict = {"status": "error"}
+    try:
+        failures: list[str] = []  # with --keep-going
+        packages: list[tuple[str, PackageHeader]] = []
+        for source in args.source:
+            try:
+                events.start("parse", source=source)
+                with open(source, 'r') as f:
+                    package_xml = f.read()
+
+                # Full parsing with parse_package_string() is deferred until
+                # the package expression is rendered.
+                pkg = PackageHeader(package_xml)
+                pkg.evaluate_conditions(NixPackage._get_condition_context(args.distro))
+                packages.append((source, pkg))
+                events.finish("parse", pkg.name, source=source)
+            except Exception as e:
+                events.finish("parse", source=source, status="error", error=str(e))
+                err(f'Failed to parse {source}')
+                if not args.keep_going:
+                    raise e
+                failures.append(f"{source}: {e}")
+
+        # Names of all workspace packages, including those not selected below
+        workspace_pkg_names = {NixPackage.normalize_name(pkg.name) for _, pkg in packages}
+
+        if args.packages_select or args.packages_up_to:
+            known = {pkg.name for _, pkg in packages}
+            unknown = [n for n in args.packages_select + args.packages_up_to if n not in known]
+            if unknown:
+                err(f"Unknown workspace package(s): {', '.join(unknown)}")
+                return 1
+            selected = select_packages(
+                packages, args.packages_select, args.packages_up_to, args.distros
             )
-            build_inputs -= propagated_build_inputs
-
-            check_inputs = resolve_dependencies(test_deps)
-            check_inputs -= build_inputs
-
-            native_build_inputs = resolve_dependencies(buildtool_deps | buildtool_export_deps)
-
-            kwargs = {}
-            patches = []
+            # Keep the other workspace packages in the overlay and in
+            # shell.nix so that dependencies of the selected ones remain
+            # available
+            for source, pkg in packages:
+                if (source, pkg) in selected:
+                    continue
+                found = existing_expressions(source, pkg, args)
+                for distro, file_name in found.items():
+                    expressions[distro][NixPackage.normalize_name(pkg.name)] = file_name
+                if args.overlay and len(found) < len(args.distros):
+                    warn(f"No expression for {pkg.name} found, it will be missing in the overlay")
+                if args.shell:
+                    for distro in args.distros:
+                        pkg.evaluate_conditions(NixPackage._get_condition_context(distro))
+                        all_dependencies[distro] |= set().union(
+                            *get_package_inputs(pkg, args).values()
+                        )
+            packages = selected
+
+        released: dict[str, dict] = {distro: {} for distro in args.distros}
+        if args.skip_released:
+            for distro in args.distros:
+                try:
+                    released[distro] = released_packages(args, distro)
+                except Exception as exc:
+                    warn(f"Cannot get released packages for {distro}, not skipping any: {exc}")
+        skipped: list[str] = []  # with --skip-released
+
+        cache_misses: list[str] = []  # with --cache-only
+        saved_cache = dict(git_cache)
+
+        def save_cache():
+            """Store git cache if changed, so that work done so far is not lost on failures."""
+            nonlocal saved_cache
+            if args.no_cache or git_cache == saved_cache:
+                return
+            try:
+                save_git_cache(args.cache_file, git_cache)
+                saved_cache = dict(git_cache)
+            except Exception as exc:
+                warn(f"warning: Cannot store {args.cache_file}: {exc}")
+
+        @contextmanager
+        def package_step(index: int, source: str, pkg: PackageHeader):
+            events.start("package", pkg.name, source=source, index=index, total=len(packages))
+            try:
+                yield
+                events.finish("package", pkg.name, status="ok")
+            except CacheMiss as e:
+                events.finish("package", pkg.name, status="cache-miss")
+                cache_misses.append(f"{pkg.name}: {e}")
+            except Exception as e:
+                events.finish("package", pkg.name, status="error", error=str(e))
+                if not args.keep_going:
+                    raise
+                failures.append(f"{pkg.name} ({source}): {e}")
+                # Keep the expression generated by a previous run in the overlay
+                for distro, file_name in existing_expressions(source, pkg, args).items():
+                    expressions[distro][NixPackage.normalize_name(pkg.name)] = file_name
+            finally:
+                save_cache()
+
+        # (toplevel, base) -> formatted commits, with --patches
+        repo_patches: dict[tuple[str, str], list] = {}
+        # (toplevel, rev) -> {prefix: commit}, with --use-per-package-src
+        last_commits: dict[tuple[str, str], dict[str, str]] = {}
+        for index, (source, pkg) in enumerate(packages):
+            with package_step(index, source, pkg):
+                try:
+                    # Conditions in package.xml are evaluated separately for each
+                    # distro, everything else is shared.
+                    events.start("resolve", pkg.name)
+                    inputs: dict[str, dict[str, set[str]]] = {}
+                    build_types: dict[str, str] = {}
+                    for distro in args.distros:
+                        pkg.evaluate_conditions(NixPackage._get_condition_context(distro))
+                        inputs[distro] = get_package_inputs(pkg, args)
+                        build_types[distro] = pkg.get_build_type()
+                        all_dependencies[distro] |= set().union(*inputs[distro].values())
+                        # checkInputs are not needed to build a package
+                        workspace_deps[distro][NixPackage.normalize_name(pkg.name)] = set().union(
+                            *(v for k, v in inputs[distro].items() if k != "check_inputs")
+                        )
+                    events.finish("resolve", pkg.name)
+
+                    kwargs = {}
+                    patches = []
+                    src_sha256 = None  # known only with --fetch
+                    local_changes = False  # commits not available upstream, with --fetch
+
+                    if args.src_param:
+                        kwargs["src_param"] = args.src_param
+                        kwargs["src_expr"] = args.src_param
+                    elif args.fetch:
+                        events.start("git", pkg.name)
+                        srcdir = os.path.dirname(source) or "."
+
+                        def check_output(cmd: List[str]):
+                            return subprocess.check_output(cmd, cwd=srcdir).decode().strip()
+
+                        url = check_output("git config remote.origin.url".split())
+                        prefix = check_output("git rev-parse --show-prefix".split())
+                        toplevel = check_output("git rev-parse --show-toplevel".split())
+                        head = check_output("git rev-parse HEAD".split())
+
+                        def merge_base_to_upstream(commit: str) -> str:
+                            return (
+                                subprocess.check_output(
+                                    f"git merge-base {commit} $(git for-each-ref refs/remotes/origin --format='%(objectname)')",
+                                    cwd=srcdir,
+                                    shell=True,
+                                )
+                                .decode()
+                                .strip()
+                            )
 
-            if args.src_param:
-                kwargs["src_param"] = args.src_param
-                kwargs["src_expr"] = args.src_param
-            elif args.fetch:
-                srcdir = os.path.dirname(source) or "."
+                        if args.use_per_package_src:
+                            # Set head to point to the last commit the subdirectory was changed. This is
+                            # not strictly necessary, but it will increase hit rate of git_cache.
+                            # Filter out locally applied patches
+                            merge_base = merge_base_to_upstream(head)
+                            if (toplevel, merge_base) not in last_commits:
+                                # Find commits for all packages from this repo at once
+                                prefixes = {prefix}
+                                for other_source, _ in packages:
+                                    rel = os.path.relpath(
+                                        os.path.realpath(os.path.dirname(other_source) or "."),
+                                        os.path.realpath(toplevel),
+                                    )
+                                    if rel == ".":
+                                        prefixes.add("")
+                                    elif not rel.startswith(".." + os.sep):
+                                        prefixes.add(rel + "/")
+                                last_commits[(toplevel, merge_base)] = last_modifying_commits(
+                                    toplevel, merge_base, prefixes
+                                )
+                            head = last_commits[(toplevel, merge_base)].get(prefix) or check_output(
+                                f"git rev-list {merge_base} -1 -- .".split()
+                            )
 
-                def check_output(cmd: List[str]):
-                    return subprocess.check_output(cmd, cwd=srcdir).decode().strip()
+                        def cache_key(url, prefix):
+                            if args.use_per_package_src:
+                                return f"{url}?dir={prefix}"
+                            return url
+
+                        # Latest commit present in the upstream repo. If
+                        # the local repository doesn't have additional
+                        # commits, it is the same as HEAD. Should work
+                        # even with detached HEAD.
+                        upstream_rev = merge_base_to_upstream(head)
+                        events.finish("git", pkg.name)
+                        sparse_prefix = prefix if args.use_per_package_src else ""
+                        if (
+                            args.fetch == "flake-inputs"
+                            and args.use_per_package_src
+                            and not args.skip_released
+                        ):
+                            # The source is the whole repository flake input,
+                            # prefetched below, so the hash of the sparse
+                            # checkout would not be used.
+                            info = {"rev": upstream_rev}
+                        else:
+                            info = git_cache_lookup(
+                                git_cache,
+                                cache_key(url, prefix),
+                                toplevel,
+                                upstream_rev,
+                                sparse_prefix,
+                            )
+                            cache_hit = info is not None
+                            events.start("prefetch", pkg.name, cache_hit=cache_hit)
+                            if info is None:
+                                info = git_prefetch(
+                                    git_cache,
+                                    cache_key(url, prefix),
+                                    url,
+                                    toplevel,
+                                    upstream_rev,
+                                    sparse_prefix,
+                                    args.git_mirror,
+                                    args.cache_only,
+                                )
+                            events.finish("prefetch", pkg.name, cache_hit=cache_hit)
+                            src_sha256 = info["sha256"]
+
+                        match = re.match(
+                            r"https://(?P<auth>.*:[^@]*@)?github\.com/(?P<owner>[^/]*)/(?P<repo>.*?)(?:\.git|/.*)?$",
+                            url,
+                        )
+                        sparse_checkout = (
+                            f"""sparseCheckout = ["{prefix}"];
+                                nonConeMode = true;"""
+                            if prefix and args.use_per_package_src
+                            else ""
+                        )
 
-                url = check_output("git config remote.origin.url".split())
-                prefix = check_output("git rev-parse --show-prefix".split())
-                toplevel = check_output("git rev-parse --show-toplevel".split())
-                head = check_output("git rev-parse HEAD".split())
+                        if args.fetch == "flake-inputs":
+                            if match is not None:
+                                ident = nix_ident(match['repo'])
+                                kwargs["src_param"] = "rosSources"
+                                kwargs["src_expr"] = f"rosSources.{ident}"
+                                # Flake inputs fetch whole repositories, shared by
+                                # all packages from the repository. Pin them to the
+                                # upstream revision of the repository, not to the
+                                # last commit changing this package.
+                                repo_rev = merge_base if args.use_per_package_src else info["rev"]
+                                if source_repos.get(ident, {}).get("rev") != repo_rev:
+                                    repo_info = (
+                                        git_cache_lookup(git_cache, url, toplevel, repo_rev)
+                                        if args.use_per_package_src
+                                        else info
+                                    )
+                                    if repo_info is None:
+                                        repo_info = git_prefetch(
+                                            git_cache,
+                                            url,
+                                            url,
+                                            toplevel,
+                                            repo_rev,
+                                            "",
+                                            args.git_mirror,
+                                            args.cache_only,
+                                        )
+                                    source_repos.update(
+                                        {
+                                            ident: {
+                                                "owner": match["owner"],
+                                                "repo": match["repo"],
+                                                "rev": repo_rev,
+                                                "narHash": sri_hash(repo_info["sha256"]),
+                                                "lastModified": int(
+                                                    check_output(
+                                                        [
+                                                            "git",
+                                                            "log",
+                                                            "-1",
+                                                            "--format=%ct",
+                                                            repo_rev,
+                                                        ]
+                                                    )
+                                                ),
+                                            }
+                                        }
+                                    )  # makes sure that we don't have the same repo multiple times
+                            else:
+                                msg = f"Unsupported repository URL: {url}. Please, file an issue."
+                                err(msg)
+                                raise Exception(msg)
+                        elif forge := forge_source(url, args.forge_host, bool(sparse_checkout)):
+                            if re.match(r"https?://[^/@]*:[^/@]*@", url):
+                                warn(
+                                    f"Repository URL {url} contains authentication information, which is not supported by nixpkgs fetchers and will be ignored. "
+                                    "Consider using --fetch=flake-inputs with configured access-tokens in nix.conf."
+                                )
+                            fetcher, attrs = forge
+                            forge_attrs = "\n".join(f'{k} = "{v}";' for k, v in attrs.items())
+                            kwargs["src_param"] = fetcher
+                            kwargs["src_expr"] = strip_empty_lines(
+                                dedent(f'''
+                                    {fetcher} {{
+                                      {indent(forge_attrs, "                                  ").strip()}
+                                      rev = "{info["rev"]}";
+                                      sha256 = "{info["sha256"]}";
+                                      {sparse_checkout}
+                                    }}''')
+                            ).strip()
+                        else:
+                            kwargs["src_param"] = "fetchgit"
+                            kwargs["src_expr"] = strip_empty_lines(
+                                dedent(f'''
+                                    fetchgit {{
+                                      url = "{url}";
+                                      rev = "{info["rev"]}";
+                                      sha256 = "{info["sha256"]}";
+                                      {sparse_checkout}
+                                    }}''')
+                            ).strip()
+
+                        if prefix:
+                            # kwargs["src_expr"] = f'''let fullSrc = {kwargs["src_expr"]}; in "${{fullSrc}}/{prefix}"'''
+                            if args.fetch == "flake-inputs":
+                                kwargs["source_root"] = f"source/{prefix}"
+                            else:
+                                kwargs["source_root"] = f"${{src.name}}/{prefix}"
+
+                        if args.patches:
+                            patch_base = merge_base if args.use_per_package_src else upstream_rev
+                            if (toplevel, patch_base) not in repo_patches:
+                                repo_patches[(toplevel, patch_base)] = format_patches(
+                                    toplevel, patch_base
+                                )
+                            patches = package_patches(repo_patches[(toplevel, patch_base)], prefix)
+                        elif head != upstream_rev:
+                            warn(
+                                f"{toplevel} contains commits not available upstream. Consider using --patches"
+                            )
+                        local_changes = bool(patches) or head != upstream_rev
+                        if args.skip_released and args.use_per_package_src and not local_changes:
+                            # head is the last upstream commit changing the package here
+                            local_changes = bool(
+                                check_output(
+                                    ["git", "rev-list", "-1", f"{merge_base}..HEAD", "--", "."]
+                                )
+                            )
 
-                def merge_base_to_upstream(commit: str) -> str:
-                    return (
-                        subprocess.check_output(
-                            f"git merge-base {commit} $(git for-each-ref refs/remotes/origin --format='%(objectname)')",
-                            cwd=srcdir,
-                            shell=True,
-                        )
-                        .decode()
-                        .strip()
-                    )
+                    else:
+                        if args.output_dir is None:
+                            kwargs["src_expr"] = "./."
+                        else:
+                            kwargs["src_expr"] = (
+                                f"./{os.path.dirname(os.path.relpath(source, args.output_dir)) or '.'}"
+                            )
 
-                if args.use_per_package_src:
-                    # Set head to point to the last commit the subdirectory was changed. This is
-                    # not strictly necessary, but it will increase hit rate of git_cache.
-                    merge_base = merge_base_to_upstream(head)  # filter out locally applied patches
-                    head = check_output(f"git rev-list {merge_base} -1 -- .".split())
-
-                def cache_key(url, prefix):
-                    if args.use_per_package_src:
-                        return f"{url}?dir={prefix}"
-                    return url
-
-                # Latest commit present in the upstream repo. If
-                # the local repository doesn't have additional
-                # commits, it is the same as HEAD. Should work
-                # even with detached HEAD.
-                upstream_rev = merge_base_to_upstream(head)
-                info = git_cache.get(cache_key(url, prefix))
-                if info is None or info["rev"] != upstream_rev:
-                    info = json.loads(
-                        subprocess.check_output(
-                            ["nix-prefetch-git", "--quiet"]
-                            + (
-                                ["--sparse-checkout", prefix, "--non-cone-mode"]
-                                if prefix and args.use_per_package_src
-                                else []
+                        if args.output_as_pkg_dir:
+                            kwargs["src_expr"] = (
+                                f"./{os.path.relpath(os.path.dirname(source), os.path.join(args.output_dir, NixPackage.normalize_name(pkg.name)))}"
                             )
-                            + [toplevel, upstream_rev],
-                        ).decode()
-                    )
-                    git_cache[cache_key(url, prefix)] = {k: info[k] for k in ["rev", "sha256"]}
 
-                match = re.match(
-                    r"https://(?P<auth>.*:[^@]*@)?github\.com/(?P<owner>[^/]*)/(?P<repo>.*?)(?:\.git|/.*)?$",
-                    url,
-                )
-                sparse_checkout = (
-                    f"""sparseCheckout = ["{prefix}"];
-                        nonConeMode = true;"""
-                    if prefix and args.use_per_package_src
-                    else ""
-                )
+                        if args.filter_src:
+                            # The pure variant reads only the given .gitignore
+                            # file, whereas gitignoreSource collects nested
+                            # .gitignore files in a derivation, which makes
+                            # evaluation build it (import from derivation).
+                            patterns = src_filter_patterns.copy()
+                            if os.path.exists(os.path.join(os.path.dirname(source), ".gitignore")):
+                                patterns.append(
+                                    "./"
+                                    + os.path.normpath(
+                                        os.path.join(kwargs["src_expr"], ".gitignore")
+                                    )
+                                )
+                            kwargs["src_param"] = "nix-gitignore"
+                            kwargs["src_expr"] = (
+                                f"nix-gitignore.gitignoreSourcePure [ {' '.join(patterns)} ] {kwargs['src_expr']}"
+                            )
 
-                if args.fetch == "flake-inputs":
-                    if match is not None:
-                        ident = nix_ident(match['repo'])
-                        kwargs["src_param"] = "rosSources"
-                        kwargs["src_expr"] = f"rosSources.{ident}"
-                        source_repos.update(
-                            {
-                                ident: {
-                                    "owner": match["owner"],
-                                    "repo": match["repo"],
-                                    "rev": info["rev"],
-                                }
-                            }
-                        )  # makes sure that we don't have the same repo multiple times
-                    else:
-                        msg = f"Unsupported repository URL: {url}. Please, file an issue."
-                        err(msg)
-                        raise Exception(msg)
-                elif match is not None:
-                    if match["auth"] is not None:
-                        warn(
-                            f"Repository URL {url} contains authentication information, which is not supported by nixpkgs fetchers and will be ignored. "
-                            "Consider using --fetch=flake-inputs with configured access-tokens in nix.conf."
+                    if args.source_root:
+                        kwargs["source_root"] = args.source_root.replace('{package_name}', pkg.name)
+
+                    if args.do_check:
+                        kwargs["do_check"] = True
+
+                    if args.name_param:
+                        kwargs["name_param"] = args.name_param
+
+                    if args.version_param:
+                        kwargs["version_param"] = args.version_param
+
+                    if not args.packages:
+                        # Skip writing package expressions. Note that above we
+                        # still collect data needed for shell.nix.
+                        continue
+
+                    full_pkg = parse_package_string(pkg.package_xml)
+
+                except CacheMiss:
+                    raise  # handled by package_step()
+                except Exception as e:
+                    err(f'Failed to prepare Nix expression from {source}')
+                    raise e
+
+                # Resolve patch name collisions between packages sharing the output directory
+                output_file_name = get_output_file_name(source, pkg, args)
+                patch_names = []
+                for name, content in patches:
+                    candidates = itertools.chain(
+                        [name, f"{NixPackage.normalize_name(pkg.name)}-{name}"],
+                        (
+                            f"{NixPackage.normalize_name(pkg.name)}-{i}-{name}"
+                            for i in itertools.count(2)
+                        ),
+                    )
+                    for name in candidates:
+                        path = os.path.join(dirname(output_file_name), name)
+                        if patch_files.get(path, content) == content:
+                            break
+                    patch_names.append(name)
+
+                events.start("render", pkg.name)
+                derivation_texts: dict[str, str] = {}
+                for distro in args.distros:
+                    try:
+                        derivation = NixExpression(
+                            name=NixPackage.normalize_name(pkg.name),
+                            version=pkg.version,
+                            description=full_pkg.description,
+                            licenses=map(NixLicense, full_pkg.licenses),
+                            distro_name=distro,
+                            build_type=build_types[distro],
+                            name_format=args.name_format,
+                            patches=[f"./{p}" for p in patch_names],
+                            **inputs[distro],
+                            **kwargs,
                         )
-                    kwargs["src_param"] = "fetchFromGitHub"
-                    kwargs["src_expr"] = strip_empty_lines(
-                        dedent(f'''
-                            fetchFromGitHub {{
-                              owner = "{match["owner"]}";
-                              repo = "{match["repo"]}";
-                              rev = "{info["rev"]}";
-                              sha256 = "{info["sha256"]}";
-                              {sparse_checkout}
-                            }}''')
-                    ).strip()
-                else:
-                    kwargs["src_param"] = "fetchgit"
-                    kwargs["src_expr"] = strip_empty_lines(
-                        dedent(f'''
-                            fetchgit {{
-                              url = "{url}";
-                              rev = "{info["rev"]}";
-                              sha256 = "{info["sha256"]}";
-                              {sparse_checkout}
-                            }}''')
-                    ).strip()
-
-                if prefix:
-                    # kwargs["src_expr"] = f'''let fullSrc = {kwargs["src_expr"]}; in "${{fullSrc}}/{prefix}"'''
-                    if args.fetch == "flake-inputs":
-                        kwargs["source_root"] = f"source/{prefix}"
+                        derivation_text = f"# Automatically generated by: {our_cmd_line}\n"
+                        derivation_text += derivation.get_text(args.copyright_holder, args.license)
+                    except UnresolvedDependency as e:
+                        err(f"Failed to resolve required dependencies for package {pkg.name}!")
+                        raise e
+                    except Exception as e:
+                        err('Failed to generate derivation for package {}!'.format(pkg.name))
+                        raise e
+
+                    if args.nixfmt:
+                        derivation_text = nixfmt(derivation_text)
+                    derivation_texts[distro] = derivation_text
+                events.finish("render", pkg.name)
+
+                try:
+                    events.start("write", pkg.name)
+                    # Distros with identical expressions share a single file
+                    if len(set(derivation_texts.values())) == 1:
+                        output_files = {output_file_name: args.distros}
                     else:
-                        kwargs["source_root"] = f"${{src.name}}/{prefix}"
-
-                if args.patches:
-                    patches = (
-                        subprocess.check_output(
-                            dedent(f"""
-                                for i in $(git rev-list --reverse --relative {upstream_rev}..HEAD -- .); do
-                                  git format-patch --zero-commit --relative --no-signature -1 $i
-                                done"""),
-                            shell=True,
-                            cwd=srcdir,
+                        output_files = {
+                            distro_file_name(output_file_name, distro): [distro]
+                            for distro in args.distros
+                        }
+                    for file_name, distros in output_files.items():
+                        with file_writer(file_name, args.compare) as recipe_file:
+                            recipe_file.write(derivation_texts[distros[0]])
+                        for distro in distros:
+                            if not local_changes and matches_release(
+                                pkg, src_sha256, released[distro]
+                            ):
+                                skipped.append(f"{pkg.name} ({distro})")
+                                continue
+                            expressions[distro][NixPackage.normalize_name(pkg.name)] = file_name
+                    for name, (_, content) in zip(patch_names, patches):
+                        patch_filename = os.path.join(dirname(output_file_name), name)
+                        if patch_filename in patch_files:
+                            continue  # identical patch already written for another package
+                        patch_files[patch_filename] = content
+                        with file_writer(patch_filename, args.compare) as patch_dest:
+                            patch_dest.write(content)
+                    events.finish("write", pkg.name)
+                    if not args.compare:
+                        ok(
+                            f"Successfully generated derivation for package '{pkg.name}' as "
+                            + ", ".join(f"'{f}'" for f in output_files)
+                            + "."
                         )
-                        .decode()
-                        .strip()
-                        .splitlines()
-                    )
-                elif head != upstream_rev:
-                    warn(
-                        f"{toplevel} contains commits not available upstream. Consider using --patches"
-                    )
-
-            else:
-                if args.output_dir is None:
-                    kwargs["src_expr"] = "./."
-                else:
-                    kwargs["src_expr"] = (
-                        f"./{os.path.dirname(os.path.relpath(source, args.output_dir)) or '.'}"
-                    )
-
-                if args.output_as_pkg_dir:
-                    kwargs["src_expr"] = (
-                        f"./{os.path.relpath(os.path.dirname(source), os.path.join(args.output_dir, NixPackage.normalize_name(pkg.name)))}"
-                    )
-
-            if args.source_root:
-                kwargs["source_root"] = args.source_root.replace('{package_name}', pkg.name)
-
-            if args.do_check:
-                kwargs["do_check"] = True
-
-            if args.name_param:
-                kwargs["name_param"] = args.name_param
-
-            if args.version_param:
-                kwargs["version_param"] = args.version_param
-
-            derivation = NixExpression(
-                name=NixPackage.normalize_name(pkg.name),
-                version=pkg.version,
-                description=pkg.description,
-                licenses=map(NixLicense, pkg.licenses),
-                distro_name=args.distro,
-                build_type=pkg.get_build_type(),
-                name_format=args.name_format,
-                build_inputs=build_inputs | set(args.extra_build_inputs),
-                propagated_build_inputs=propagated_build_inputs
-                | set(args.extra_propagated_build_inputs),
-                check_inputs=check_inputs | set(args.extra_check_inputs),
-                native_build_inputs=native_build_inputs | set(args.extra_native_build_inputs),
-                patches=[f"./{p}" for p in patches],
-                **kwargs,
+                except Exception as e:
+                    err("Failed to write derivation to disk!")
+                    raise e
+
+        if cache_misses:
+            err(
+                f"{len(cache_misses)} package(s) not found in {args.cache_file}:\n  "
+                + "\n  ".join(cache_misses)
             )
-            our_pkg_names.add(derivation.name)
-            all_dependencies |= (
-                derivation.build_inputs
-                | derivation.native_build_inputs
-                | derivation.propagated_build_inputs
-                | derivation.propagated_native_build_inputs
-                | derivation.check_inputs
+            run_fields.update(
+                status="cache-miss", failures=len(failures), cache_misses=len(cache_misses)
             )
+            return 1
 
-            if not args.packages:
-                # Skip writing package expressions. Note that above we
-                # still collect data needed for shell.nix.
-                continue
-
-        except Exception as e:
-            err(f'Failed to prepare Nix expression from {source}')
-            raise e
-
-        try:
-            derivation_text = f"# Automatically generated by: {our_cmd_line}\n"
-            derivation_text += derivation.get_text(args.copyright_holder, args.license)
-        except UnresolvedDependency as e:
-            err(f"Failed to resolve required dependencies for package {pkg}!")
-            raise e
-        except Exception as e:
-            err('Failed to generate derivation for package {}!'.format(pkg))
-            raise e
-
-        if args.nixfmt:
-            derivation_text = nixfmt(derivation_text)
-
-        try:
-            output_file_name = get_output_file_name(source, pkg, args)
-            with file_writer(output_file_name, args.compare) as recipe_file:
-                recipe_file.write(derivation_text)
-            for patch in patches:
-                patch_filename = os.path.join(dirname(output_file_name), patch)
-                if not patch_filename in patch_filenames:
-                    patch_filenames.add(patch_filename)
+        if skipped and not args.compare:
+            ok(
+                f"Not adding {len(skipped)} package(s) matching released versions to overlay:\n  "
+                + "\n  ".join(skipped)
+            )
+
+        if args.overlay:
+            for distro in args.distros:
+                if args.overlay_by_name:
+                    generate_overlay_by_name(args, overlay_file_name(args, distro), distro)
                 else:
-                    # TODO Allow better handling of patch name collisions (e.g. by
-                    # having them in per-package directories, perhaps via
-                    # --output_subdir_as_nix_pkg_name)
-                    msg = f"Patch {patch_filename} already exists"
-                    err(msg)
-                    raise Exception(msg)
-                with file_writer(patch_filename, args.compare) as patch_dest, open(
-                    os.path.join(os.path.dirname(source), patch), "r"
-                ) as patch_src:
-                    patch_dest.write(patch_src.read())
-            if not args.compare:
-                ok(
-                    f"Successfully generated derivation for package '{pkg.name}' as '{output_file_name}'."
+                    generate_overlay(expressions[distro], args, overlay_file_name(args, distro))
+
+        if args.shell:
+            shell_deps = {
+                distro: deps - workspace_pkg_names for distro, deps in all_dependencies.items()
+            }
+            if args.prune_shell:
+                closure_index = args.closure_index or (
+                    xdg_cache_home() / "ros2nix" / "closure-index.json"
                 )
+                try:
+                    with open(closure_index) as f:
+                        index = json.load(f)
+                except FileNotFoundError:
+                    index = {}
+                for distro in args.distros:
+                    try:
+                        shell_deps[distro] = prune_propagated(
+                            args, distro, shell_deps[distro], index.setdefault(distro, {})
+                        )
+                    except Exception as exc:
+                        warn(f"Cannot prune shell.nix dependencies for {distro}: {exc}")
+                try:
+                    os.makedirs(os.path.dirname(os.path.abspath(closure_index)), exist_ok=True)
+                    with open(closure_index, "w") as f:
+                        json.dump(index, f, indent=1, sort_keys=True)
+                except Exception as exc:
+                    warn(f"warning: Cannot store {closure_index}: {exc}")
+            generate_shell(args, shell_deps, our_cmd_line)
+
+        if args.flake:
+            generate_flake(args, source_repos)
+            if source_repos:
+                generate_flake_lock(args, source_repos)
+        if args.default or (args.default is None and not args.flake):
+            generate_default(args)
+        if args.release:
+            generate_release(args)
+            generate_build_matrix(
+                args,
+                {
+                    distro: {
+                        name: deps & set(expressions[distro])
+                        for name, deps in workspace_deps[distro].items()
+                        if name in expressions[distro]
+                    }
+                    for distro in args.distros
+                },
+            )
 
-            expressions[NixPackage.normalize_name(pkg.name)] = output_file_name
-        except Exception as e:
-            err("Failed to write derivation to disk!")
-            raise e
-
-    if args.overlay:
-        generate_overlay(expressions, args)
-
-    if args.shell:
-        generate_shell(args, all_dependencies - our_pkg_names, our_cmd_line)
-
-    if args.flake:
-        generate_flake(args, source_repos)
-    if args.default or (args.default is None and not args.flake):
-        generate_default(args)
-        # TODO generate also release.nix (for testing/CI)?
-
-    if not args.no_cache and len(git_cache) > 0:
-        try:
-            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
-            with open(cache_file, "w") as f:
-                json.dump(git_cache, f)
-        except Exception as exc:
-            warn(f"warning: Cannot store {cache_file}: {exc}")
+        save_cache()
+        run_fields.update(status="error" if failures else "ok", failures=len(failures))
 
-    if args.compare and compare_failed:
-        err("Some files are not up-to-date")
-        return 2
+        if failures:
+            err(
+                f"Failed to generate {len(failures)} package(s):\n  "
+                + "\n  ".join(failures)
+                + "\nRerun the same command to retry them. Cached hashes will be reused."
+            )
+            return 1
+
+        if args.compare and compare_failed:
+            err("Some files are not up-to-date")
+            return 2
+    except Exception as e:
+        run_fields["error"] = str(e)
+        raise
+    finally:
+        events.finish("run", **run_fields)
+        events.close()
 
 
 def main():
     import sys
 
+    if sys.argv[1:2] == ["cache"]:
+        return cache_command(sys.argv[2:])
     return ros2nix(sys.argv[1:])
 
 
@@ -61,6 +61,69 @@ fi
     assert [ -f out/shell.nix ]
 }
 
+@test "--packages-select" {
+    cd ws
+    ros2nix --distro=jazzy --output-as-nix-pkg-name --packages-select ros_node $(find src -name package.xml)
+    assert [ -f ros-node.nix ]
+    assert [ ! -f library.nix ]
+    # Workspace packages are never taken from nixpkgs/nix-ros-overlay
+    assert_file_not_contains shell.nix "^ *library$"
+}
+
+@test "--packages-select keeps other packages in overlay and shell.nix" {
+    cd ws
+    ros2nix --distro=jazzy --output-as-nix-pkg-name $(find src -name package.xml)
+    ros2nix --distro=jazzy --output-as-nix-pkg-name --packages-select ros_node $(find src -name package.xml)
+    assert_file_contains overlay.nix "library = final.callPackage ./library.nix"
+    # Dependency of library only
+    assert_file_contains shell.nix "zlib"
+    nix-build -A rosPackages.jazzy.ros-node
+}
+
+@test "--packages-up-to" {
+    cd ws
+    ros2nix --distro=jazzy --output-as-nix-pkg-name --packages-up-to ros_node $(find src -name package.xml)
+    assert [ -f ros-node.nix ]
+    assert [ -f library.nix ]
+}
+
+@test "--packages-up-to with unknown package" {
+    cd ws
+    run ! ros2nix --packages-up-to non_existent $(find src -name package.xml)
+    assert_line --partial "Unknown workspace package(s): non_existent"
+}
+
+@test "--keep-going" {
+    mkdir ws/src/broken
+    cat > ws/src/broken/package.xml <<EOF
+<?xml version="1.0"?>
+<package format="3">
+  <name>broken</name>
+  <version>0.0.0</version>
+  <description>Package without maintainer</description>
+  <license>MIT</license>
+</package>
+EOF
+    run ros2nix --keep-going --output-as-nix-pkg-name $(find ws/src -name package.xml)
+    assert_failure
+    assert_line --partial "Failed to generate 1 package(s)"
+    assert [ -f library.nix ]
+    assert [ -f ros-node.nix ]
+    assert_file_contains overlay.nix ros-node.nix
+    assert_file_not_contains overlay.nix broken
+    nix-build -A rosPackages.rolling.ros-node
+}
+
+@test "--keep-going with malformed package.xml" {
+    mkdir ws/src/truncated
+    printf '<?xml version="1.0"?>\n<package format="3">\n  <name>trunc' > ws/src/truncated/package.xml
+    run ros2nix --keep-going --output-as-nix-pkg-name $(find ws/src -name package.xml)
+    assert_failure
+    assert_line --partial "Failed to generate 1 package(s)"
+    assert_line --partial "ws/src/truncated/package.xml"
+    assert_file_contains overlay.nix ros-node.nix
+}
+
 @test "generate just package.nix with --package-only" {
     cd ws
     ros2nix --distro=jazzy --package-only $(find src -name package.xml)
@@ -75,6 +138,20 @@ fi
     assert [ -f out/library/package.nix ]
 }
 
+@test "--prune-shell with closure index" {
+    echo '{"rolling": {"ament-cmake": [], "ament-cmake-ros": ["ament-cmake"], "ament-lint-auto": [], "ament-lint-common": [], "zlib": []}}' > index.json
+    ros2nix --prune-shell --closure-index=index.json $(find ws/src -name package.xml)
+    assert_file_contains shell.nix ament-cmake-ros
+    assert_file_not_contains shell.nix "^ *ament-cmake$"
+}
+
+@test "--prune-shell" {
+    if ! $RUN_BUILD; then skip "needs nix-ros-overlay evaluation"; fi
+    ros2nix --distro=jazzy --prune-shell --closure-index=index.json $(find ws/src -name package.xml)
+    assert_file_contains index.json ament-cmake-ros
+    nix-shell --run "cd ws && colcon build"
+}
+
 @test "nix-shell for local workspace with additional ROS package" {
     ros2nix --distro=jazzy $(find ws/src -name package.xml)
     nix-shell --arg withPackages 'p: with p; [ compressed-image-transport ]' \
@@ -176,6 +253,54 @@ EOF
     nix-build -A rosPackages.jazzy.ros-node
 }
 
+@test "--overlay-by-name" {
+    ros2nix --output-as-pkg-dir --overlay-by-name ws/src/library/package.xml
+    cp overlay.nix overlay.nix.orig
+    ros2nix --output-as-pkg-dir --overlay-by-name ws/src/ros_node/package.xml
+    # Adding a package doesn't change the overlay
+    diff overlay.nix overlay.nix.orig
+    nix-build -A rosPackages.jazzy.ros-node
+}
+
+@test "--overlay-by-name without --output-as-pkg-dir" {
+    run ! ros2nix --overlay-by-name $(find ws/src -name package.xml)
+}
+
+@test "--skip-released" {
+    cat > released.json <<EOF
+{"jazzy": {"library": {"version": "0.0.0"}, "ros_node": {"version": "0.0.1"}}}
+EOF
+    ros2nix --distro=jazzy --skip-released --released-snapshot=released.json $(find ws/src -name package.xml)
+    # Expressions are generated, but the released package is not in the overlay
+    assert [ -f ws/src/library/package.nix ]
+    refute grep library overlay.nix
+    assert grep ros-node overlay.nix
+}
+
+@test "--skip-released with local commits" {
+    git clone "$BATS_TEST_DIRNAME/.." ros2nix
+    git -C ros2nix remote set-url origin https://github.com/wentasah/ros2nix
+    pushd ros2nix
+    sed -i -e '1a// comment' test/ws/src/library/src/library.cpp
+    git commit -m 'library patch' -- test/ws/src/library/src/library.cpp
+    popd
+    cat > released.json <<EOF
+{"jazzy": {"library": {"version": "0.0.0"}}}
+EOF
+    ros2nix --distro=jazzy --fetch --patches --skip-released --released-snapshot=released.json --output-as-nix-pkg-name $(find "ros2nix/test/ws/src" -name package.xml)
+    # The fork differs from the released package
+    assert_file_contains overlay.nix "library = "
+}
+
+@test "--skip-released with source hash" {
+    cat > released.json <<EOF
+{"jazzy": {"library": {"version": "0.0.0", "sha256": "0000000000000000000000000000000000000000000000000000"}}}
+EOF
+    ros2nix --distro=jazzy --skip-released --released-snapshot=released.json $(find ws/src -name package.xml)
+    # Without --fetch, the hash cannot be compared
+    assert grep library overlay.nix
+}
+
 @test "--flake" {
     ros2nix --flake --distro=jazzy $(find ws/src -name package.xml)
     if $RUN_BUILD; then
@@ -184,6 +309,102 @@ EOF
     fi
 }
 
+@test "--release" {
+    ros2nix --distro=jazzy --release --shards=2 $(find ws/src -name package.xml)
+    assert [ -f release.nix ]
+    # ros-node depends on library, so they are built in different levels
+    # instead of different shards of the same level
+    assert_file_contains build-matrix.json '"level": 1'
+    assert_file_not_contains build-matrix.json '"shard": 1'
+    nix-build release.nix -A library -A ros-node
+}
+
+@test "--overlay-distros" {
+    ros2nix --distro=jazzy --overlay-distros=jazzy $(find ws/src -name package.xml)
+    assert_file_contains default.nix "inherit (rosPackages) jazzy;"
+    nix-build -A rosPackages.jazzy.ros-node
+    if $RUN_BUILD; then
+        run ! nix-instantiate -A rosPackages.humble.ros-node
+    fi
+}
+
+@test "multiple distros" {
+    ros2nix --distro=humble,jazzy --output-as-nix-pkg-name $(find ws/src -name package.xml)
+    # pname contains the distro name, so the expressions differ
+    assert [ -f library.humble.nix ]
+    assert [ -f library.jazzy.nix ]
+    assert [ ! -f overlay.nix ]
+    assert_file_contains overlay.humble.nix library.humble.nix
+    assert_file_contains overlay.jazzy.nix library.jazzy.nix
+    nix-build -A rosPackages.humble.ros-node -A rosPackages.jazzy.ros-node
+}
+
+@test "multiple distros with distro-independent name" {
+    ros2nix --distro=humble,jazzy --name-format={package_name} --output-as-nix-pkg-name $(find ws/src -name package.xml)
+    assert [ -f library.nix ]
+    assert [ ! -f library.humble.nix ]
+    assert_file_contains overlay.humble.nix "library = final.callPackage ./library.nix"
+    assert_file_contains overlay.jazzy.nix "library = final.callPackage ./library.nix"
+    nix-build -A rosPackages.humble.ros-node -A rosPackages.jazzy.ros-node
+}
+
+@test "multiple distros with shared expressions" {
+    ros2nix --distro=humble,jazzy --name-format "{package_name}" --output-as-nix-pkg-name $(find ws/src -name package.xml)
+    assert [ -f library.nix ]
+    assert [ ! -f library.humble.nix ]
+    assert_file_contains overlay.humble.nix library.nix
+    assert_file_contains overlay.jazzy.nix library.nix
+}
+
+@test "multiple distros with conditional build type" {
+    mkdir -p ws/src/both
+    cat > ws/src/both/package.xml <<EOF
+<?xml version="1.0"?>
+<package format="3">
+  <name>both</name>
+  <version>0.0.0</version>
+  <description>Package for ROS 1 and ROS 2</description>
+  <maintainer email="user@example.com">user</maintainer>
+  <license>MIT</license>
+  <export>
+    <build_type condition="\$ROS_VERSION == 1">catkin</build_type>
+    <build_type condition="\$ROS_VERSION == 2">ament_cmake</build_type>
+  </export>
+</package>
+EOF
+    ros2nix --distro=noetic,jazzy --output-as-nix-pkg-name ws/src/both/package.xml
+    assert_file_contains both.noetic.nix 'buildType = "catkin";'
+    assert_file_contains both.jazzy.nix 'buildType = "ament_cmake";'
+}
+
+@test "--events=jsonl" {
+    ros2nix --events=jsonl --events-file=events.jsonl $(find ws/src -name package.xml)
+    assert_file_contains events.jsonl '"event": "start", "stage": "package", "package": "library"'
+    assert_file_contains events.jsonl '"event": "finish", "stage": "package", "package": "library", "status": "ok"'
+    assert_file_contains events.jsonl '"stage": "render"'
+    assert_file_contains events.jsonl '"event": "finish", "stage": "run", "status": "ok"'
+    assert_file_contains events.jsonl '"event": "finish", "stage": "parse", "package": "library"'
+}
+
+@test "--events=jsonl with failed run" {
+    run ros2nix --events=jsonl --events-file=events.jsonl --packages-select unknown $(find ws/src -name package.xml)
+    assert_failure
+    assert_file_contains events.jsonl '"event": "finish", "stage": "run", "status": "error"'
+    echo "<package" > ws/src/library/package.xml
+    run ros2nix --events=jsonl --events-file=events.jsonl $(find ws/src -name package.xml)
+    assert_failure
+    assert_file_contains events.jsonl '"event": "finish", "stage": "run", "status": "error", "error": '
+}
+
+@test "--events=jsonl with --cache-only" {
+    git clone "$BATS_TEST_DIRNAME/.." ros2nix
+    git -C ros2nix remote set-url origin https://github.com/wentasah/ros2nix
+    run ros2nix --events=jsonl --events-file=events.jsonl --cache-file=cache.json --cache-only --fetch --output-as-nix-pkg-name $(find "ros2nix/test/ws/src" -name package.xml)
+    assert_failure
+    assert_file_contains events.jsonl '"stage": "package", "package": "library", "status": "cache-miss"'
+    assert_file_not_contains events.jsonl '"status": "ok"'
+}
+
 @test "--compare" {
     ros2nix $(find ws/src -name package.xml)
     ros2nix --compare $(find ws/src -name package.xml)
@@ -214,6 +435,25 @@ EOF
     fi
 }
 
+@test "--fetch from other forges" {
+    git clone "$BATS_TEST_DIRNAME/.." ros2nix
+    git -C ros2nix remote set-url origin git@gitlab.example.com:group/subgroup/ros2nix.git
+    ros2nix --fetch --output-as-nix-pkg-name ros2nix/test/ws/src/library/package.xml
+    assert_file_contains library.nix "fetchFromGitLab"
+    assert_file_contains library.nix 'owner = "group/subgroup";'
+    git -C ros2nix remote set-url origin https://git.example.com/owner/ros2nix
+    ros2nix --fetch --forge-host=git.example.com=gitea --output-as-nix-pkg-name ros2nix/test/ws/src/library/package.xml
+    assert_file_contains library.nix "fetchFromGitea"
+    assert_file_contains library.nix 'domain = "git.example.com";'
+    # Sparse checkouts are not supported by fetchFromGitea
+    ros2nix --fetch --use-per-package-src --forge-host=git.example.com=gitea --output-as-nix-pkg-name ros2nix/test/ws/src/library/package.xml
+    assert_file_contains library.nix "fetchgit"
+    # The port of HTTPS remotes is kept
+    git -C ros2nix remote set-url origin https://gitlab.example.com:8443/group/ros2nix
+    ros2nix --fetch --output-as-nix-pkg-name ros2nix/test/ws/src/library/package.xml
+    assert_file_contains library.nix 'domain = "gitlab.example.com:8443";'
+}
+
 @test "--patches without --fetch" {
     run ! ros2nix --patches $(find ws/src -name package.xml)
 }
@@ -246,9 +486,13 @@ EOF
     sed -i -e '1a// comment' test/ws/src/library/src/library.cpp
     git commit -m 'test patch' -- test/ws/src/library/src/library.cpp
     popd
-    run ros2nix --output-as-nix-pkg-name --fetch --patches $(find "ros2nix/test/ws/src" -name package.xml)
-    assert_failure
-    assert_line --partial "Patch ./0001-test-patch.patch already exists"
+    ros2nix --output-as-nix-pkg-name --fetch --patches ros2nix/test/ws/src/{ros_node,library}/package.xml
+    # The patch of the second package gets a unique name
+    assert_file_contains ./ros-node.nix "\./0001-test-patch\.patch"
+    assert_file_contains ./library.nix "\./library-0001-test-patch\.patch"
+    assert_file_contains ./0001-test-patch.patch "hello patch"
+    assert_file_contains ./library-0001-test-patch.patch "// comment"
+    nix-build -A rosPackages.jazzy.ros-node
 }
 
 @test "--fetch --patches with two changes, each for different package " {
@@ -268,6 +512,22 @@ EOF
     nix-build -A rosPackages.jazzy.ros-node
 }
 
+@test "--fetch --patches with a commit adding a patch file" {
+    git clone "$BATS_TEST_DIRNAME/.." ros2nix
+    git -C ros2nix remote set-url origin https://github.com/wentasah/ros2nix
+    pushd ros2nix
+    sed -i -e 's/hello world/hello patch/' test/ws/src/ros_node/src/node.cpp
+    git commit -m 'node patch' -- test/ws/src/ros_node/src/node.cpp
+    git format-patch -1 --stdout --zero-commit > test/ws/src/library/node.patch
+    git add test/ws/src/library/node.patch
+    git commit -m 'add patch file'
+    popd
+    ros2nix --output-as-nix-pkg-name --fetch --patches $(find "ros2nix/test/ws/src" -name package.xml)
+    assert_file_contains ./library.nix "\./0001-add-patch-file\.patch"
+    assert_file_contains ./ros-node.nix "\./0001-node-patch\.patch"
+    assert_file_contains ./0001-add-patch-file.patch "^+From 0000000000000000000000000000000000000000"
+}
+
 @test "--use-per-package-src" {
     git clone "$BATS_TEST_DIRNAME/.." ros2nix
     git -C ros2nix remote set-url origin https://github.com/wentasah/ros2nix
@@ -280,6 +540,105 @@ EOF
     fi
 }
 
+@test "--use-per-package-src with a merged branch" {
+    git clone "$BATS_TEST_DIRNAME/.." ros2nix
+    git -C ros2nix remote set-url origin https://github.com/wentasah/ros2nix
+    pushd ros2nix
+    git checkout -b feature
+    sed -i -e '1a// comment' test/ws/src/library/src/library.cpp
+    git commit -m 'lib change' -- test/ws/src/library/src/library.cpp
+    git checkout -
+    git merge --no-ff -m 'Merge feature' feature
+    # Pretend that the merge is upstream
+    git update-ref refs/remotes/origin/master HEAD
+    popd
+    ros2nix --output-as-nix-pkg-name --fetch --use-per-package-src ros2nix/test/ws/src/library/package.xml
+    # Same commit as from git rev-list -1 HEAD -- test/ws/src/library
+    assert_file_contains library.nix "rev = \"$(git -C ros2nix rev-parse feature)\";"
+}
+
+@test "--use-per-package-src --git-mirror" {
+    git clone "$BATS_TEST_DIRNAME/.." ros2nix
+    git -C ros2nix remote set-url origin https://github.com/wentasah/ros2nix
+    XDG_CACHE_HOME=$PWD/cache1 ros2nix --output-dir=prefetch --output-as-nix-pkg-name --fetch --use-per-package-src $(find "ros2nix/test/ws/src" -name package.xml)
+    XDG_CACHE_HOME=$PWD/cache2 ros2nix --output-dir=mirror --output-as-nix-pkg-name --fetch --use-per-package-src --git-mirror $(find "ros2nix/test/ws/src" -name package.xml)
+    diff -r prefetch mirror
+}
+
+@test "--fetch --git-mirror" {
+    git clone "$BATS_TEST_DIRNAME/.." ros2nix
+    git -C ros2nix remote set-url origin https://github.com/wentasah/ros2nix
+    XDG_CACHE_HOME=$PWD/cache1 ros2nix --output-dir=prefetch --output-as-nix-pkg-name --fetch $(find "ros2nix/test/ws/src" -name package.xml)
+    XDG_CACHE_HOME=$PWD/cache2 ros2nix --output-dir=mirror --output-as-nix-pkg-name --fetch --git-mirror $(find "ros2nix/test/ws/src" -name package.xml)
+    diff -r prefetch mirror
+    assert [ -d cache2/ros2nix/mirrors/ros2nix-*.git ]
+}
+
+@test "--fetch --git-mirror with packages in top-level directories" {
+    git init repo
+    cp -r ws/src/library ws/src/ros_node repo/
+    git -C repo add .
+    git -C repo commit -m "Initial commit"
+    git -C repo remote add origin https://github.com/example/repo
+    git -C repo update-ref refs/remotes/origin/master HEAD
+    XDG_CACHE_HOME=$PWD/cache1 ros2nix --output-dir=prefetch --output-as-nix-pkg-name --fetch --use-per-package-src $(find repo -name package.xml)
+    XDG_CACHE_HOME=$PWD/cache2 ros2nix --output-dir=mirror --output-as-nix-pkg-name --fetch --use-per-package-src --git-mirror $(find repo -name package.xml)
+    diff -r prefetch mirror
+}
+
+@test "--git-mirror without --fetch" {
+    run ! ros2nix --git-mirror $(find ws/src -name package.xml)
+}
+
+@test "ros2nix cache export/import" {
+    git clone "$BATS_TEST_DIRNAME/.." ros2nix
+    git -C ros2nix remote set-url origin https://github.com/wentasah/ros2nix
+    ros2nix --cache-file=cache1.json --fetch --output-dir=out1 --output-as-nix-pkg-name $(find "ros2nix/test/ws/src" -name package.xml)
+    ros2nix cache export --cache-file=cache1.json shared.json
+    ros2nix cache import --cache-file=cache2.json shared.json
+    # Everything is cached, so nix-prefetch-git must not be called
+    mkdir bin && printf '#!/bin/sh\nexit 1\n' > bin/nix-prefetch-git && chmod +x bin/nix-prefetch-git
+    PATH=$PWD/bin:$PATH ros2nix --cache-file=cache2.json --fetch --output-dir=out2 --output-as-nix-pkg-name $(find "ros2nix/test/ws/src" -name package.xml)
+    diff -r out1 out2
+}
+
+@test "--cache-only" {
+    git clone "$BATS_TEST_DIRNAME/.." ros2nix
+    git -C ros2nix remote set-url origin https://github.com/wentasah/ros2nix
+    run ros2nix --cache-file=cache.json --cache-only --fetch --output-as-nix-pkg-name $(find "ros2nix/test/ws/src" -name package.xml)
+    assert_failure
+    assert_line --partial "2 package(s) not found"
+    assert [ ! -f overlay.nix ]
+    ros2nix --cache-file=cache.json --fetch --output-as-nix-pkg-name $(find "ros2nix/test/ws/src" -name package.xml)
+    ros2nix --cache-file=cache.json --cache-only --fetch --output-as-nix-pkg-name --compare $(find "ros2nix/test/ws/src" -name package.xml)
+}
+
+@test "git cache is shared by identical trees" {
+    git clone "$BATS_TEST_DIRNAME/.." ros2nix
+    git -C ros2nix remote set-url origin https://github.com/wentasah/ros2nix
+    ros2nix --cache-file=cache.json --fetch --use-per-package-src --output-dir=upstream --output-as-nix-pkg-name $(find "ros2nix/test/ws/src" -name package.xml)
+    assert_file_contains cache.json "git-tree:"
+    # A fork with the same content is found in the cache by its tree IDs
+    git -C ros2nix remote set-url origin https://github.com/fork/ros2nix
+    ros2nix --cache-file=cache.json --cache-only --fetch --use-per-package-src --output-dir=fork --output-as-nix-pkg-name $(find "ros2nix/test/ws/src" -name package.xml)
+}
+
+@test "ros2nix cache import with conflicting hash" {
+    echo '{"url": {"rev": "1234", "sha256": "aaaa"}}' > cache.json
+    echo '{"url": {"rev": "1234", "sha256": "bbbb"}, "url2": {"rev": "5678", "sha256": "cccc"}}' > shared.json
+    run ros2nix cache import --cache-file=cache.json shared.json
+    assert_success
+    assert_line --partial "Conflicting hashes for url"
+    assert_file_contains cache.json aaaa
+    assert_file_contains cache.json cccc
+}
+
+@test "ros2nix cache import of non-existent file" {
+    run ! ros2nix cache import --cache-file=cache.json non-existent.json
+    assert_line --partial "non-existent.json does not exist"
+    assert [ ! -f cache.json ]
+}
+
 @test "--fetch=flake-inputs" {
     git clone "$BATS_TEST_DIRNAME/.." ros2nix
     git -C ros2nix remote set-url origin https://github.com/wentasah/ros2nix
@@ -289,12 +648,39 @@ EOF
     # Check that package files reference rosSources
     assert_file_contains ros-node.nix "rosSources.ros2nix"
     assert_file_contains library.nix "rosSources.ros2nix"
+    # Inputs are pinned and locked
+    rev=$(git -C ros2nix rev-parse HEAD)
+    assert_file_contains flake.nix "github:wentasah/ros2nix/$rev"
+    assert_file_contains flake.lock "\"narHash\": \"sha256-"
     if $RUN_BUILD; then
+        # Nix agrees with the locked hash
+        narhash=$(grep -o 'sha256-[^"]*' flake.lock)
+        nix flake lock path:"${PWD}"
+        assert_file_contains flake.lock "$narhash"
         nix flake check path:"${PWD}"
         nix build path:"${PWD}#ros-node"
     fi
 }
 
+@test "--fetch=flake-inputs --use-per-package-src with packages changed in different commits" {
+    git clone "$BATS_TEST_DIRNAME/.." ros2nix
+    git -C ros2nix remote set-url origin https://github.com/wentasah/ros2nix
+    pushd ros2nix
+    sed -i -e '1a// comment' test/ws/src/library/src/library.cpp
+    git commit -m 'lib change' -- test/ws/src/library/src/library.cpp
+    sed -i -e 's/hello world/hello change/' test/ws/src/ros_node/src/node.cpp
+    git commit -m 'node change' -- test/ws/src/ros_node/src/node.cpp
+    # Pretend that the commits are upstream
+    git update-ref refs/remotes/origin/master HEAD
+    popd
+    # Process ros_node first so that the last package is library
+    ros2nix --output-as-nix-pkg-name --flake --fetch=flake-inputs --use-per-package-src ros2nix/test/ws/src/{ros_node,library}/package.xml
+    # The shared input is pinned to the upstream revision of the repository
+    rev=$(git -C ros2nix rev-parse HEAD)
+    assert_file_contains flake.nix "github:wentasah/ros2nix/$rev"
+    assert_file_contains flake.lock "\"rev\": \"$rev\""
+}
+
 @test "--fetch=flake-inputs with two repositories" {
     git clone "$BATS_TEST_DIRNAME/.." ros2nix-1
     git clone "$BATS_TEST_DIRNAME/.." ros2nix-2
@@ -333,6 +719,24 @@ EOF
     fi
 }
 
+@test "--filter-src" {
+    echo "*.log" > ws/src/library/.gitignore
+    ros2nix --filter-src $(find ws/src -name package.xml)
+    assert_file_contains ws/src/library/package.nix "nix-gitignore.gitignoreSourcePure"
+    assert_file_contains ws/src/library/package.nix './.gitignore ] ./.;'
+    nix-build -A rosPackages.rolling.library
+    if $RUN_BUILD; then
+        drv=$(nix-instantiate -A rosPackages.rolling.library)
+        mkdir ws/src/library/build
+        touch ws/src/library/build/artifact ws/src/library/data.bag ws/src/library/debug.log
+        assert_equal "$(nix-instantiate -A rosPackages.rolling.library)" "$drv"
+    fi
+}
+
+@test "--filter-src with --fetch" {
+    run ! ros2nix --filter-src --fetch $(find ws/src -name package.xml)
+}
+
 @test "--src-param" {
     cd ws/src/library
 